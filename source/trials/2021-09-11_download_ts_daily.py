@@ -3,6 +3,7 @@
 #--------1---------2---------3---------4---------5---------6---------7----|
 
 from datetime import datetime
+from io import BytesIO
 import os.path
 import pandas as pd
 import sqlite3
@@ -13,6 +14,9 @@ from typing import Final
 MY_MODULES: Final = "/home/gmaubach/Programming/StockTradingApp2/Source"
 sys.path.append(MY_MODULES)
 from read_symbols_from_company_list import read_symbols_from_company_list
+from http_client import HttpClient
+
+HTTP_CLIENT = HttpClient()
 
 def download_ts_daily(
     apikey: str = None,
@@ -119,7 +123,8 @@ def download_ts_daily(
             print(URL)
         
         # ts = time series.
-        ts_daily = pd.read_csv(URL)
+        # Downloaded through the shared keep-alive session with retries.
+        ts_daily = pd.read_csv(BytesIO(HTTP_CLIENT.get(URL).content))
         
         # Add symbol for all rows
         ts_daily["symbol"] = [symbol] * len(ts_daily)       
@@ -3,9 +3,14 @@
 #--------1---------2---------3---------4---------5---------6---------7----|
 
 # == INCLUDE ==
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import math
+import matplotlib.style
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 import matplotlib.pyplot as plt
+from multiprocessing import shared_memory
 import numpy as np
 import os.path
 import pandas as pd
@@ -21,26 +26,209 @@ path_2_my_libs: Final = "~/Programming/StockTradingApp2/Source/"
 sys.path.append(path_2_my_libs)
 
 # == VAR ==
+# Arrays attached from shared memory in each worker of optimize_sma_grid().
+shared_arrays = {}
+
+# == CLASS ==
+class IncrementalSMA:
+
+    r"""
+    
+    Incremental Simple Moving Averages
+    
+    Short and long simple moving averages of a stream of prices updated
+    in constant time per bar, with the regime and crossovers of
+    calc_sma_regime() and calc_crossovers().
+    
+    Parameters
+    ----------
+    sma_short: int, required
+       Amount of steps for short period of simple moving average
+    sma_long: int, required
+       Amount of steps for long period of simple moving average
+    
+    Notes
+    -----
+    A ring buffer holds the last sma_long + 1 cumulative sums and counts
+    of missing values. The running sum is accumulated in the same order
+    and with the same operations as calc_cumsum() and
+    calc_sma_from_cumsum(), so the results are bitwise equal to the
+    batch calculation over the same bars.
+    """
+
+    def __init__(self, sma_short: int, sma_long: int):
+        if not 0 < sma_short < sma_long:
+            raise ValueError(f"Wrong values for 'sma_short' and 'sma_long'! Must be 0 < sma_short < sma_long.")
+        self.sma_short = sma_short
+        self.sma_long = sma_long
+        self.size = sma_long + 1
+        # Slot i % size holds the cumulative sum and count of the first i bars.
+        self.sums = [0.0] * self.size
+        self.counts = [0] * self.size
+        self.length = 0
+        # Last non-zero regime, crosses through 0 are compared against it.
+        self.regime = 0
+
+    def window(self, period: int) -> float:
+        if self.length < period:
+            return math.nan
+        first = (self.length - period) % self.size
+        last = self.length % self.size
+        if self.counts[last] - self.counts[first] > 0:
+            return math.nan
+        return (self.sums[last] - self.sums[first]) / period
+
+    def update(self, values) -> dict:
+
+        r"""
+        
+        Update Simple Moving Averages
+        
+        Parameters
+        ----------
+        values : float or numpy.ndarray, required
+            The price of one new bar or the prices of a micro-batch of
+            new bars in ascending order.
+            
+        Returns
+        -------
+        dict
+            Arrays with one value per new bar:
+            'sma_short': short simple moving average
+            'sma_long': long simple moving average
+            'regime': regime as int8
+            'signal': crossover as int8
+        """
+
+        # == BEGIN ==
+        # -- PROC --
+        values = np.atleast_1d(np.asarray(values, dtype = np.float64)).tolist()
+        out = {
+            "sma_short": np.empty(len(values)),
+            "sma_long": np.empty(len(values)),
+            "regime": np.zeros(len(values), dtype = np.int8),
+            "signal": np.zeros(len(values), dtype = np.int8)
+            }
+        
+        for i, value in enumerate(values):
+            previous = self.length % self.size
+            self.length += 1
+            missing = value != value
+            self.sums[self.length % self.size] = self.sums[previous] + (0.0 if missing else value)
+            self.counts[self.length % self.size] = self.counts[previous] + missing
+            
+            sma_short = self.window(self.sma_short)
+            sma_long = self.window(self.sma_long)
+            spread = sma_short - sma_long
+            regime = 0 if spread != spread else (spread > 0) - (spread < 0)
+            
+            out["sma_short"][i] = sma_short
+            out["sma_long"][i] = sma_long
+            out["regime"][i] = regime
+            if regime != self.regime and regime != 0 and self.regime != 0:
+                out["signal"][i] = regime
+            if regime != 0:
+                self.regime = regime
+        
+        # -- OUT --
+        return out
+        # == End ==
 
 # == FUNC ==
-def calc_simple_mov_avg(data = [], period = 1) -> pandas.DataFrame:
+def calc_cumsum(data: np.ndarray) -> tuple:
 
     r"""
     
-    Calculate Simple Moving Average
+    Calculate Cumulative Sums for Moving Averages
     
     Parameters
     ----------
+    data : numpy.ndarray, required
+        Time series data in ascending order along the first axis. A
+        2D array holds one time series per column.
+        
+    Returns
+    -------
+    tuple
+        The cumulative sums and the cumulative counts of missing values,
+        both with a leading row of zeros. The sum of the values i to
+        j - 1 is sums[j] - sums[i].
     
-    data : list, required
-        List of time series data.
+    Notes
+    -----
+    Missing values are summed as zero and counted, so a window
+    containing any missing value can be set to NaN like
+    pandas.Series.rolling() does, instead of spoiling all
+    following windows.
+    """
+
+    # == BEGIN ==
+    # -- PROC --
+    data = np.asarray(data, dtype = np.float64)
+    missing = np.isnan(data)
+    zeros = np.zeros((1,) + data.shape[1:])
+    sums = np.concatenate([zeros, np.cumsum(np.where(missing, 0.0, data), axis = 0)])
+    counts = np.concatenate([zeros.astype(np.int64), np.cumsum(missing, axis = 0)])
+    
+    # -- OUT --
+    return sums, counts
+    # == End ==
+
+def calc_sma_from_cumsum(sums: np.ndarray, counts: np.ndarray, period: int) -> np.ndarray:
+
+    r"""
+    
+    Calculate Simple Moving Average from Cumulative Sums
+    
+    Parameters
+    ----------
+    sums : numpy.ndarray, required
+        Cumulative sums as returned by calc_cumsum().
+    counts : numpy.ndarray, required
+        Cumulative counts of missing values as returned by calc_cumsum().
     period : integer, required
         Number representing the period to include into moving average.
         
+    Returns
+    -------
+    numpy.ndarray
+        The simple moving average with the shape of the original data.
+        The first period - 1 values and windows containing missing
+        values are NaN.
+    """
+
+    # == BEGIN ==
+    # -- PROC --
+    sma = np.full((len(sums) - 1,) + sums.shape[1:], np.nan)
+    if period < len(sums):
+        sma[period - 1:] = (sums[period:] - sums[:-period]) / period
+        sma[period - 1:][(counts[period:] - counts[:-period]) > 0] = np.nan
+    
+    # -- OUT --
+    return sma
+    # == End ==
+
+def calc_simple_mov_avg(data = [], periods = [1]) -> pd.DataFrame:
+
+    r"""
+    
+    Calculate Simple Moving Average
+    
+    Parameters
+    ----------
+    
+    data : numpy.ndarray or pandas.Series, required
+        Time series data in ascending order.
+    periods : list, required
+        List of numbers representing the periods to include into moving
+        averages.
+        
     Returns
     -------
     pandas.DataFrame
-        The simple moving average for the provided list data.
+        The simple moving averages for the provided data with one
+        column 'sma_<period>' for each period. The index is taken
+        from data if data is a pandas.Series.
     
     Notes
     -----
@@ -51,6 +239,9 @@ def calc_simple_mov_avg(data = [], period = 1) -> pandas.DataFrame:
     last access So 2021-09-12
     
     Modularisation and preparation for optimization by the author.
+    
+    All periods are calculated in one pass from the same cumulative
+    sums instead of one rolling window per period.
     """
 
     # == BEGIN ==    
@@ -58,26 +249,568 @@ def calc_simple_mov_avg(data = [], period = 1) -> pandas.DataFrame:
     # Paraphrase.
     if __debug__:
         print(f"data: {data}")
-        print(f"period: {period}")
+        print(f"periods: {periods}")
     
     # Check data.
-    if not isinstance(data, list) or len(data) == 0:
+    if not isinstance(data, (list, np.ndarray, pd.Series)) or len(data) == 0:
         raise ValueError(f"Wrong values for argument 'data'!")
     
+    # Check periods.
+    if (not isinstance(periods, list) or len(periods) == 0 or
+        not all(isinstance(period, (int, np.integer)) and period > 0 for period in periods)):
+        raise ValueError(f"Wrong values for argument 'periods'! Must be a list of positive integers.")
+    
     # -- PROC --
-    sma = data.rolling(window = period).mean()
+    sums, counts = calc_cumsum(np.asarray(data, dtype = np.float64))
+    sma = {
+        f"sma_{period}": calc_sma_from_cumsum(sums, counts, period)
+        for period in periods
+        }
     
     # -- OUT --
-    return pd.DataFrame(sma)
+    return pd.DataFrame(sma, index = data.index if isinstance(data, pd.Series) else None)
     # == End ==
     
+def read_price_panel(
+    db_file: str,
+    symbols: list = [],
+    start_date: str = "0000-00-00",
+    end_date: str = "9999-99-99",
+    column: str = "close") -> pd.DataFrame:
+
+    r"""
+    
+    Read Price Panel
+    
+    Read the prices of many symbols from table ts_daily with one query.
+    
+    Parameters
+    ----------
+    db_file : str, required
+        Path and filename of the database.
+    symbols : list
+        List of symbols. If empty all symbols in ts_daily are read.
+    start_date : str
+        The first date to read given as 'YYYY-MM-DD'.
+    end_date : str
+        The last date to read given as 'YYYY-MM-DD'.
+    column : str
+        The price column of ts_daily to read.
+        
+    Returns
+    -------
+    pandas.DataFrame
+        Dates x symbols panel with dates in ascending order. Dates
+        without a price for a symbol are NaN. Of dates stored more than
+        once the latest stored price is used.
+    """
+
+    # == BEGIN ==
+    # -- IN --
+    # Paraphrase.
+    if __debug__:
+        print(f"db_file: {db_file}")
+        print(f"symbols: {symbols}")
+        print(f"start_date: {start_date}")
+        print(f"end_date: {end_date}")
+        print(f"column: {column}")
+    
+    # Check column. Column names cannot be passed as SQL parameters.
+    if column not in ("open", "high", "low", "close", "volume"):
+        raise ValueError(f"Wrong value for argument 'column'!")
+    
+    # -- PROC --
+    cmd = f"SELECT timestamp, symbol, {column} FROM ts_daily WHERE timestamp BETWEEN ? AND ?"
+    params = [start_date, end_date]
+    if len(symbols) > 0:
+        cmd += f" AND symbol IN ({', '.join('?' * len(symbols))})"
+        params += list(symbols)
+    
+    with sqlite3.connect(db_file) as connection:
+        df = pd.read_sql(cmd + " ORDER BY rowid ASC;", connection, params = params)
+    connection.close()
+    
+    # ts_daily has no unique key and downloads are appended, so a date may
+    # be stored more than once. The latest download wins.
+    df = df.drop_duplicates(["timestamp", "symbol"], keep = "last")
+    panel = df.pivot(index = "timestamp", columns = "symbol", values = column).sort_index()
+    
+    # -- OUT --
+    return panel
+    # == End ==
+
+def calc_sma_regime(
+    sums: np.ndarray,
+    counts: np.ndarray,
+    sma_short: int,
+    sma_long: int) -> np.ndarray:
+
+    r"""
+    
+    Calculate Simple Moving Average Regime
+    
+    Parameters
+    ----------
+    sums : numpy.ndarray, required
+        Cumulative sums as returned by calc_cumsum().
+    counts : numpy.ndarray, required
+        Cumulative counts of missing values as returned by calc_cumsum().
+    sma_short: int, required
+       Amount of steps for short period of simple moving average
+    sma_long: int, required
+       Amount of steps for long period of simple moving average
+        
+    Returns
+    -------
+    numpy.ndarray
+        1 where the short average is above the long one, -1 where it is
+        below and 0 where it is equal or any average is missing, as int8
+        with the shape of the original data.
+    """
+
+    # == BEGIN ==
+    # -- PROC --
+    spread = calc_sma_from_cumsum(sums, counts, sma_short) - calc_sma_from_cumsum(sums, counts, sma_long)
+    regime = np.sign(np.nan_to_num(spread, nan = 0.0)).astype(np.int8)
+    
+    # -- OUT --
+    return regime
+    # == End ==
+
+def calc_crossovers(regime: np.ndarray) -> np.ndarray:
+
+    r"""
+    
+    Calculate Crossovers
+    
+    Parameters
+    ----------
+    regime : numpy.ndarray, required
+        Regime as returned by calc_sma_regime().
+        
+    Returns
+    -------
+    numpy.ndarray
+        1 where the short average crosses above the long one, -1 where it
+        crosses below and 0 elsewhere, as int8 with the shape of regime.
+        
+    Notes
+    -----
+    Each regime is compared with the last non-zero regime before it, so a
+    cross passing through equal averages or missing values is reported
+    on the first step after it.
+    """
+
+    # == BEGIN ==
+    # -- PROC --
+    signals = np.zeros_like(regime)
+    if len(regime) < 2:
+        return signals
+    
+    # Position of the last non-zero regime up to each step, -1 if none.
+    steps = np.arange(len(regime)).reshape((-1,) + (1,) * (regime.ndim - 1))
+    last = np.maximum.accumulate(np.where(regime != 0, steps, -1), axis = 0)[:-1]
+    previous = np.take_along_axis(regime, np.maximum(last, 0), axis = 0)
+    previous[last < 0] = 0
+    
+    changed = (regime[1:] != previous) & (regime[1:] != 0) & (previous != 0)
+    signals[1:][changed] = regime[1:][changed]
+    
+    # -- OUT --
+    return signals
+    # == End ==
+
+def calc_sma_crossovers(
+    data: pd.DataFrame,
+    sma_short: int,
+    sma_long: int) -> tuple:
+
+    r"""
+    
+    Calculate Simple Moving Average Crossovers
+    
+    Calculate the crossovers of all symbols of a price panel at once.
+    
+    Parameters
+    ----------
+    data : pandas.DataFrame, required
+        Dates x symbols panel as returned by read_price_panel().
+    sma_short: int, required
+       Amount of steps for short period of simple moving average
+    sma_long: int, required
+       Amount of steps for long period of simple moving average
+        
+    Returns
+    -------
+    tuple
+        The crossovers as int8 array of dates x symbols as returned by
+        calc_crossovers() and a pandas.DataFrame with one row
+        'timestamp', 'symbol', 'signal' per crossover.
+    """
+
+    # == BEGIN ==
+    # -- IN --
+    # Paraphrase.
+    if __debug__:
+        print(f"data: {data.shape}")
+        print(f"sma_short: {sma_short}")
+        print(f"sma_long: {sma_long}")
+    
+    # Check periods.
+    if not 0 < sma_short < sma_long:
+        raise ValueError(f"Wrong values for 'sma_short' and 'sma_long'! Must be 0 < sma_short < sma_long.")
+    
+    # -- PROC --
+    sums, counts = calc_cumsum(data.to_numpy(dtype = np.float64))
+    signals = calc_crossovers(calc_sma_regime(sums, counts, sma_short, sma_long))
+    
+    rows, cols = np.nonzero(signals)
+    events = pd.DataFrame({
+        "timestamp": data.index.to_numpy()[rows],
+        "symbol": data.columns.to_numpy()[cols],
+        "signal": signals[rows, cols]
+        })
+    
+    # -- OUT --
+    return signals, events
+    # == End ==
+
+def calc_backtest(
+    prices: np.ndarray,
+    regime: np.ndarray,
+    cost: float = 0.001,
+    long_only: bool = True) -> dict:
+
+    r"""
+    
+    Calculate Backtest
+    
+    Backtest trading the regime of simple moving averages.
+    
+    Parameters
+    ----------
+    prices : numpy.ndarray, required
+        Prices in ascending order along the first axis. A 2D array holds
+        one symbol per column.
+    regime : numpy.ndarray, required
+        Regime as returned by calc_sma_regime() with the shape of prices.
+    cost : float
+        Transaction costs as fraction of the traded value, e. g. 0.001
+        for 0.1 %.
+    long_only : bool
+        Flag to stay out of the market instead of going short when the
+        short average is below the long one.
+        
+    Returns
+    -------
+    dict
+        Arrays with the shape of prices:
+        'position': position held during each step
+        'returns': returns of the prices
+        'costs': transaction costs of each step
+        'strategy': returns of the strategy after costs
+        'equity': equity curve starting with 1
+        'drawdown': drawdown from the previous high of the equity
+        
+    Notes
+    -----
+    The position is taken at the close of the step of the signal, so it
+    earns the return of the following step.
+    """
+
+    # == BEGIN ==
+    # -- PROC --
+    prices = np.asarray(prices, dtype = np.float64)
+    
+    position = np.zeros(prices.shape)
+    position[1:] = np.clip(regime[:-1], 0, 1) if long_only else regime[:-1]
+    
+    returns = np.zeros(prices.shape)
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        returns[1:] = prices[1:] / prices[:-1] - 1
+    returns = np.nan_to_num(returns, nan = 0.0, posinf = 0.0, neginf = 0.0)
+    
+    costs = np.abs(np.diff(position, axis = 0, prepend = 0)) * cost
+    strategy = position * returns - costs
+    equity = np.cumprod(1 + strategy, axis = 0)
+    drawdown = equity / np.maximum.accumulate(equity, axis = 0) - 1
+    
+    # -- OUT --
+    return {
+        "position": position,
+        "returns": returns,
+        "costs": costs,
+        "strategy": strategy,
+        "equity": equity,
+        "drawdown": drawdown
+        }
+    # == End ==
+
+def summarise_backtest(
+    backtest: dict,
+    symbols: list = None,
+    periods_per_year: int = 252) -> pd.DataFrame:
+
+    r"""
+    
+    Summarise Backtest
+    
+    Parameters
+    ----------
+    backtest : dict, required
+        Backtest as returned by calc_backtest().
+    symbols : list
+        Symbols of the columns of the backtest used as index.
+    periods_per_year : int
+        Number of steps per year to annualise the Sharpe ratio.
+        
+    Returns
+    -------
+    pandas.DataFrame
+        One row per symbol with 'total_return', 'sharpe_ratio',
+        'max_drawdown', 'trades' and 'costs'.
+    """
+
+    # == BEGIN ==
+    # -- PROC --
+    strategy = backtest["strategy"]
+    mean = strategy.mean(axis = 0)
+    std = strategy.std(axis = 0)
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        sharpe_ratio = np.where(std > 0, mean / std * np.sqrt(periods_per_year), np.nan)
+    
+    df = pd.DataFrame({
+        "total_return": np.atleast_1d(backtest["equity"][-1] - 1),
+        "sharpe_ratio": np.atleast_1d(sharpe_ratio),
+        "max_drawdown": np.atleast_1d(backtest["drawdown"].min(axis = 0)),
+        "trades": np.atleast_1d(np.count_nonzero(np.diff(backtest["position"], axis = 0, prepend = 0), axis = 0)),
+        "costs": np.atleast_1d(backtest["costs"].sum(axis = 0))
+        }, index = symbols)
+    
+    # -- OUT --
+    return df
+    # == End ==
+
+def attach_shared_arrays(specs: dict) -> None:
+
+    r"""
+    
+    Attach Shared Arrays
+    
+    Initializer of the workers of optimize_sma_grid().
+    
+    Parameters
+    ----------
+    specs : dict, required
+        Name of the shared memory block, shape and dtype by array name.
+    """
+
+    # == BEGIN ==
+    # -- PROC --
+    for key, (name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name = name)
+        # Keep the block referenced as long as the array is in use.
+        shared_arrays[key] = (block, np.ndarray(shape, dtype = dtype, buffer = block.buf))
+    # == End ==
+
+def evaluate_sma_short(sma_short: int, long_periods: list, cost: float = 0.001) -> list:
+
+    r"""
+    
+    Evaluate Simple Moving Average Pairs
+    
+    Backtest one short period against many long periods on the prices
+    attached by attach_shared_arrays(). The short average is calculated
+    once for all long periods.
+    
+    Parameters
+    ----------
+    sma_short: int, required
+       Amount of steps for short period of simple moving average
+    long_periods: list, required
+       Amounts of steps for long periods of simple moving average
+    cost : float
+        Transaction costs as fraction of the traded value.
+        
+    Returns
+    -------
+    list
+        One dictionary per pair of periods with the mean and median
+        total return and the mean maximum drawdown of all symbols as
+        calculated by calc_backtest(), and the number of crossovers.
+    """
+
+    # == BEGIN ==
+    # -- PROC --
+    prices = shared_arrays["prices"][1]
+    sums = shared_arrays["sums"][1]
+    counts = shared_arrays["counts"][1]
+    
+    short = calc_sma_from_cumsum(sums, counts, sma_short)
+    results = []
+    for sma_long in long_periods:
+        if sma_long <= sma_short:
+            continue
+        spread = short - calc_sma_from_cumsum(sums, counts, sma_long)
+        regime = np.sign(np.nan_to_num(spread, nan = 0.0)).astype(np.int8)
+        backtest = calc_backtest(prices, regime, cost = cost)
+        total_return = backtest["equity"][-1] - 1
+        results.append({
+            "sma_short": sma_short,
+            "sma_long": sma_long,
+            "mean_total_return": total_return.mean(),
+            "median_total_return": np.median(total_return),
+            "mean_max_drawdown": backtest["drawdown"].min(axis = 0).mean(),
+            "crossovers": int(np.count_nonzero(calc_crossovers(regime)))
+            })
+    
+    # -- OUT --
+    return results
+    # == End ==
+
+def optimize_sma_grid(
+    data: pd.DataFrame,
+    short_periods: list,
+    long_periods: list,
+    cost: float = 0.001,
+    max_workers: int = None) -> pd.DataFrame:
+
+    r"""
+    
+    Optimize Simple Moving Average Periods
+    
+    Evaluate every pair of a short and a longer period over all symbols
+    of a price panel in a process pool.
+    
+    Parameters
+    ----------
+    data : pandas.DataFrame, required
+        Dates x symbols panel as returned by read_price_panel().
+    short_periods: list, required
+       Amounts of steps for short periods of simple moving average
+    long_periods: list, required
+       Amounts of steps for long periods of simple moving average
+    cost : float
+        Transaction costs as fraction of the traded value.
+    max_workers: int
+       Number of worker processes. Defaults to the number of CPUs.
+        
+    Returns
+    -------
+    pandas.DataFrame
+        One row per pair of periods as returned by evaluate_sma_short(),
+        ranked by 'mean_total_return' in descending order.
+    
+    Notes
+    -----
+    The prices and cumulative sums are placed into shared memory once.
+    Workers attach to them by name, so no price array is pickled per
+    task. Each task is one short period.
+    """
+
+    # == BEGIN ==
+    # -- IN --
+    # Paraphrase.
+    if __debug__:
+        print(f"data: {data.shape}")
+        print(f"short_periods: {short_periods}")
+        print(f"long_periods: {long_periods}")
+        print(f"cost: {cost}")
+        print(f"max_workers: {max_workers}")
+    
+    # -- PROC --
+    prices = data.to_numpy(dtype = np.float64)
+    sums, counts = calc_cumsum(prices)
+    
+    blocks = []
+    specs = {}
+    try:
+        for key, array in {"prices": prices, "sums": sums, "counts": counts}.items():
+            block = shared_memory.SharedMemory(create = True, size = max(1, array.nbytes))
+            blocks.append(block)
+            np.ndarray(array.shape, dtype = array.dtype, buffer = block.buf)[...] = array
+            specs[key] = (block.name, array.shape, array.dtype)
+        del prices, sums, counts
+        
+        long_periods = sorted(long_periods)
+        with ProcessPoolExecutor(
+            max_workers = max_workers,
+            initializer = attach_shared_arrays,
+            initargs = (specs,)) as executor:
+            futures = [
+                executor.submit(evaluate_sma_short, sma_short, long_periods, cost)
+                for sma_short in sorted(short_periods)
+                ]
+            results = [result for future in futures for result in future.result()]
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    
+    df = pd.DataFrame(results, columns = ["sma_short", "sma_long", "mean_total_return", "median_total_return", "mean_max_drawdown", "crossovers"])
+    df = df.sort_values("mean_total_return", ascending = False, ignore_index = True)
+    df.insert(0, "rank", np.arange(1, len(df) + 1))
+    
+    # -- OUT --
+    return df
+    # == End ==
+
+def downsample_min_max(data: pd.Series, buckets: int) -> pd.Series:
+
+    r"""
+    
+    Downsample Time Series by Minimum and Maximum
+    
+    Parameters
+    ----------
+    data : pandas.Series, required
+        Time series data in ascending order.
+    buckets : int, required
+        Number of buckets, e. g. the width of the plot in pixels.
+        
+    Returns
+    -------
+    pandas.Series
+        The minimum and the maximum of each bucket in their original
+        order, at most 2 * buckets values. Shorter data is returned
+        unchanged.
+        
+    Notes
+    -----
+    Keeping both extremes of each pixel column draws the same envelope
+    as plotting all values, so peaks and crossovers stay visible.
+    """
+
+    # == BEGIN ==
+    # -- PROC --
+    if len(data) <= 2 * buckets:
+        return data
+    
+    values = data.to_numpy(dtype = np.float64)
+    size = -(-len(values) // buckets)
+    padded = np.full(size * buckets, np.nan)
+    padded[:len(values)] = values
+    padded = padded.reshape(buckets, size)
+    
+    # Missing values never win, all missing buckets keep their first position.
+    offsets = np.arange(buckets) * size
+    first = offsets + np.argmin(np.where(np.isnan(padded), np.inf, padded), axis = 1)
+    second = offsets + np.argmax(np.where(np.isnan(padded), -np.inf, padded), axis = 1)
+    positions = np.unique(np.concatenate([first, second]))
+    positions = positions[positions < len(values)]
+    
+    # -- OUT --
+    return data.iloc[positions]
+    # == End ==
+
 def plot_simple_mov_avg(
-    symbol: str = "",
-    data: pandas.DataFrame,
+    symbol: str,
+    data: pd.DataFrame,
     sma_short: int,
     sma_long: int,
     show_plot: bool = False,
-    filename: str = ""):
+    filename: str = "",
+    dpi: int = 100):
     
     r"""
     
@@ -101,6 +834,15 @@ def plot_simple_mov_avg(
     filename: str
        Path and filename for plot to be stored. If empty plot is
        not saved to disk.
+    dpi: int
+       Resolution of the stored plot in dots per inch.
+    
+    Notes
+    -----
+    The figure is drawn on its own Agg canvas without pyplot state, so
+    plots can be drawn in parallel. Pyplot is only used to show the plot.
+    Each series is downsampled to two values per pixel column by
+    downsample_min_max().
    
     """
     
@@ -114,40 +856,206 @@ def plot_simple_mov_avg(
         print(f"'sma_long': {sma_long}")
         print(f"'show_plot': {show_plot}")
         print(f"'filename': {filename}")
+        print(f"'dpi': {dpi}")
         
     # Check Symbol.
-    if not isinstance(symbol, str) and len(symbol) == 0:
+    if not isinstance(symbol, str) or len(symbol) == 0:
         raise ValueError(f"Wrong argument value for {symbol}. Must be string in upper case.")
     
     # -- CONFIG --
-    plt.style.use('fivethirtyeight')
-    plt.rcParams['figure.figsize'] = (15, 8)
-    plt.plot(data['close'], label = symbol, linewidth = 5, alpha = 0.3)
-    plt.plot(data['sma_short'], label = 'SMA SHORT')
-    plt.plot(data['sma_long'], label = 'SMA_LONG')
-    plt.title(f'{symbol}: Simple Moving Averages ({sma_short}, {sma_long})')
-    plt.legend(loc = 'upper left')
+    figsize = (15, 8)
+    buckets = figsize[0] * dpi
+    # Dates read from the database are strings, which would be drawn as
+    # one category per date.
+    if pd.api.types.is_string_dtype(data.index) or pd.api.types.is_object_dtype(data.index):
+        data = data.set_axis(pd.to_datetime(data.index))
     
-    # -- OUT --
+    with matplotlib.style.context('fivethirtyeight'):
+        if show_plot:
+            figure = plt.figure(figsize = figsize, dpi = dpi)
+        else:
+            figure = Figure(figsize = figsize, dpi = dpi)
+            FigureCanvasAgg(figure)
+        axes = figure.add_subplot()
+        close = downsample_min_max(data['close'], buckets)
+        axes.plot(close.index, close, label = symbol, linewidth = 5, alpha = 0.3)
+        short = downsample_min_max(data['sma_short'], buckets)
+        axes.plot(short.index, short, label = 'SMA SHORT')
+        long = downsample_min_max(data['sma_long'], buckets)
+        axes.plot(long.index, long, label = 'SMA_LONG')
+        axes.set_title(f'{symbol}: Simple Moving Averages ({sma_short}, {sma_long})')
+        axes.legend(loc = 'upper left')
+    
+        # -- OUT --
+        if len(filename) > 0:
+            figure.savefig(fname = filename)
+
     if show_plot:
         plt.show()
+    # == End ==
+
+def render_sma_chart(
+    symbol: str,
+    data: pd.Series,
+    sma_short: int,
+    sma_long: int,
+    filename: str) -> str:
+
+    r"""
+    
+    Render Simple Moving Average Chart
+    
+    Calculate the simple moving averages of one symbol and store their
+    plot. Task of render_sma_charts().
+    
+    Parameters
+    ----------
+    symbol : str, required
+        The stock identifier given as a symbol.
+    data : pandas.Series, required
+        Closing stock rates in ascending order.
+    sma_short: int, required
+       Amount of steps for short period of simple moving average
+    sma_long: int, required
+       Amount of steps for long period of simple moving average
+    filename: str, required
+       Path and filename for plot to be stored.
+        
+    Returns
+    -------
+    str
+        The filename.
+    """
 
-    if len(filename) > 0:
-       plt.savefig(fname = filename, orientation = "landscape")	
+    # == BEGIN ==
+    # -- PROC --
+    data = data.dropna()
+    sma = calc_simple_mov_avg(data, [sma_short, sma_long])
+    df = pd.DataFrame({
+        "close": data,
+        "sma_short": sma[f"sma_{sma_short}"],
+        "sma_long": sma[f"sma_{sma_long}"]
+        })
+    plot_simple_mov_avg(symbol, df, sma_short, sma_long, filename = filename)
+    
+    # -- OUT --
+    return filename
+    # == End ==
+
+def render_sma_charts(
+    data: pd.DataFrame,
+    sma_short: int,
+    sma_long: int,
+    out_dir: str,
+    max_workers: int = None) -> list:
+
+    r"""
+    
+    Render Simple Moving Average Charts
+    
+    Store the plots of all symbols of a price panel in a process pool.
+    
+    Parameters
+    ----------
+    data : pandas.DataFrame, required
+        Dates x symbols panel as returned by read_price_panel().
+    sma_short: int, required
+       Amount of steps for short period of simple moving average
+    sma_long: int, required
+       Amount of steps for long period of simple moving average
+    out_dir: str, required
+       Directory for the plots, stored as '<symbol>_sma.png'.
+    max_workers: int
+       Number of worker processes. Defaults to the number of CPUs.
+        
+    Returns
+    -------
+    list
+        The filenames of the plots.
+    """
+
+    # == BEGIN ==
+    # -- IN --
+    # Paraphrase.
+    if __debug__:
+        print(f"data: {data.shape}")
+        print(f"sma_short: {sma_short}")
+        print(f"sma_long: {sma_long}")
+        print(f"out_dir: {out_dir}")
+        print(f"max_workers: {max_workers}")
+    
+    # -- PROC --
+    symbols = list(data.columns)
+    with ProcessPoolExecutor(max_workers = max_workers) as executor:
+        filenames = list(executor.map(
+            render_sma_chart,
+            symbols,
+            [data[symbol] for symbol in symbols],
+            [sma_short] * len(symbols),
+            [sma_long] * len(symbols),
+            [os.path.join(out_dir, f"{symbol}_sma.png") for symbol in symbols],
+            chunksize = max(1, len(symbols) // (4 * (max_workers or os.cpu_count() or 1)))))
+    
+    # -- OUT --
+    return filenames
     # == End ==
 
 if __name__ == "__main__":
     
     # == CONST ==
+    DB_FILE: Final = "/home/gmaubach/Programming/StockTradingApp2/Data/StockTradingDB.sqlite"
+    SYMBOL: Final = "ATVI"
    
     # == VAR ==
     periods = [["short", 20], ["long", 50]]
      
     # == BEGIN ==
+    # -- IN --
+    with sqlite3.connect(DB_FILE) as connection:
+        df_ts = pd.read_sql(
+            "SELECT timestamp, close FROM ts_daily WHERE symbol = ? ORDER BY timestamp ASC;",
+            connection,
+            params = (SYMBOL,),
+            index_col = "timestamp")
+    connection.close()
+    
     # -- PROC --
-    # Calculate Simple Moving Average.
-    for period in periods:
-        df_ts[f'sma_{period[0]}'] = calc_simple_mov_avg(df_ts['close'], period[1])
+    # Calculate Simple Moving Averages.
+    sma = calc_simple_mov_avg(df_ts['close'], [period[1] for period in periods])
+    sma.columns = [f"sma_{period[0]}" for period in periods]
+    df_ts = df_ts.join(sma)
+    
+    # -- OUT --
+    plot_simple_mov_avg(
+        symbol = SYMBOL,
+        data = df_ts,
+        sma_short = periods[0][1],
+        sma_long = periods[1][1],
+        filename = f"{SYMBOL}_sma.png")
+    
+    # Crossovers for all symbols.
+    panel = read_price_panel(DB_FILE)
+    signals, events = calc_sma_crossovers(panel, periods[0][1], periods[1][1])
+    print(f"Crossovers of {panel.shape[1]} symbols:\n {events.tail()}")
+    
+    # Best pairs of periods for all symbols.
+    ranking = optimize_sma_grid(panel, list(range(5, 105)), list(range(10, 310, 3)))
+    print(f"Best periods:\n {ranking.head(10)}")
+    
+    # Backtest of the chosen periods.
+    sums, counts = calc_cumsum(panel.to_numpy(dtype = np.float64))
+    backtest = calc_backtest(panel.to_numpy(dtype = np.float64), calc_sma_regime(sums, counts, periods[0][1], periods[1][1]))
+    print(f"Backtest:\n {summarise_backtest(backtest, symbols = list(panel.columns)).describe()}")
+    
+    # Live updates bar by bar.
+    live = IncrementalSMA(periods[0][1], periods[1][1])
+    for close in df_ts["close"]:
+        state = live.update(close)
+    print(f"Live SMA {SYMBOL}: {state}")
+    
+    # Charts for all symbols.
+    filenames = render_sma_charts(panel, periods[0][1], periods[1][1], os.path.dirname(DB_FILE))
+    print(f"Charts: {len(filenames)}")
     # == END ==
         
 # EOF .    
@@ -4,11 +4,9 @@
 
 # == INCLUDE ==
 from datetime import datetime
-import numpy as np
 import pandas as pd
 import os.path
 import sqlite3
-import time
 from typing import Final
 
 # == FUNC ==
@@ -62,6 +60,165 @@ def calc_volatility(data = []) -> int:
     return volatility
     # == End ==
     
+def ensure_ts_daily_index(db_file: str) -> None:
+
+    """
+    
+    Ensure index on ts_daily
+    
+    Create the index on ts_daily (symbol, timestamp, close) if it does
+    not exist. It holds all columns read by read_close_prices() in the
+    requested order.
+    
+    Parameters
+    ----------
+    db_file : str, required
+        Path and filename of the database.
+        
+    """
+    
+    # == Begin ==
+    # -- Proc --
+    with sqlite3.connect(db_file) as connection:
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS ix_ts_daily_symbol_timestamp "
+            "ON ts_daily (symbol, timestamp, close);")
+    connection.close()
+    # == End ==
+
+def read_close_prices(
+    db_file: str,
+    start_date: str,
+    end_date: str,
+    symbols: list = []) -> pd.DataFrame:
+
+    """
+    
+    Read close prices
+    
+    Read the close prices of many symbols with one query.
+    
+    Parameters
+    ----------
+    db_file : str, required
+        Path and filename of the database.
+    start_date : str, required
+        The first date to read given as 'YYYY-MM-DD'.
+    end_date : str, required
+        The last date to read given as 'YYYY-MM-DD'.
+    symbols : list
+        List of symbols. If empty all symbols in ts_daily are read.
+   
+    Returns
+    -------
+    pandas.DataFrame
+        The columns 'symbol', 'timestamp' and 'close' ordered by symbol
+        and timestamp.
+        
+    Notes
+    -----
+    With the index of ensure_ts_daily_index() SQLite answers the query
+    from the index alone, neither reading the table nor sorting.
+    
+    """
+    
+    # == Begin ==
+    # -- In --
+    # Paraphrase.
+    if __debug__:
+        print(f"db_file:    {db_file}")
+        print(f"start_date: {start_date}")
+        print(f"end_date:   {end_date}")
+        print(f"symbols:    {symbols}")
+
+    # -- Proc --
+    cmd = [
+        "SELECT symbol, timestamp, close FROM ts_daily ",
+        "WHERE (timestamp BETWEEN ? AND ?) "
+        ]
+    params = [start_date, end_date]
+    if len(symbols) > 0:
+        cmd.append(f"AND symbol IN ({', '.join('?' * len(symbols))}) ")
+        params += list(symbols)
+    cmd.append("ORDER BY symbol ASC, timestamp ASC;")
+    cmd = "".join(cmd)
+    if __debug__:
+        print(f"SQL: {cmd}")
+    
+    with sqlite3.connect(db_file) as connection:
+        df = pd.read_sql(cmd, connection, params = params)
+    connection.close()
+
+    # -- Out --
+    return df
+    # == End ==
+
+def calc_volatility_batch(data: pd.DataFrame) -> pd.DataFrame:
+
+    """
+    
+    Calculate volatility for many symbols
+    
+    Calculate the volatility of calc_volatility() for all symbols at
+    once. Results agree with calc_volatility() up to rounding in the
+    last digit, as the sums are formed in a different order.
+    
+    Parameters
+    ----------
+    data : pandas.DataFrame, required
+        The columns 'symbol' and 'close' ordered by symbol and
+        timestamp as returned by read_close_prices().
+   
+    Returns
+    -------
+    pandas.DataFrame
+        The columns 'symbol' and 'volatility' with one row per symbol.
+        
+    """
+    
+    # == Begin ==
+    # -- Proc --
+    close = data["close"].astype("float64")
+    changes = close.groupby(data["symbol"], sort = False).pct_change()*100
+    volatility = changes.groupby(data["symbol"], sort = False).std()
+
+    # -- Out --
+    return volatility.rename("volatility").rename_axis("symbol").reset_index()
+    # == End ==
+
+def write_volatility(db_file: str, data: pd.DataFrame) -> None:
+
+    """
+    
+    Write volatility
+    
+    Replace table t_volatility in one transaction.
+    
+    Parameters
+    ----------
+    db_file : str, required
+        Path and filename of the database.
+    data : pandas.DataFrame, required
+        The columns 'symbol' and 'volatility' as returned by
+        calc_volatility_batch().
+        
+    """
+    
+    # == Begin ==
+    # -- Proc --
+    rows = [
+        (symbol, None if pd.isna(volatility) else float(volatility))
+        for symbol, volatility in zip(data["symbol"], data["volatility"])
+        ]
+    with sqlite3.connect(db_file) as connection:
+        # Readers see either the old or the new table, never none.
+        connection.execute("BEGIN;")
+        connection.execute("DROP TABLE IF EXISTS t_volatility;")
+        connection.execute("CREATE TABLE t_volatility (symbol TEXT, volatility REAL);")
+        connection.executemany("INSERT INTO t_volatility VALUES (?, ?);", rows)
+    connection.close()
+    # == End ==
+
 if __name__ == "__main__":
 
     # == Const ==
@@ -74,55 +231,30 @@ if __name__ == "__main__":
     # == VAR ==
     if __debug__:
         symbols = ["ATVI"]
-        print(f"Symbols: {symbols}")
     else:
-        cmd = f"SELECT DISTINCT symbol from ts_daily;"
-        with sqlite3.connect(DB_FILE) as connection:
-            cursor = connection.cursor()
-            cursor.execute(cmd)
-            connection.commit()
-            symbols = [row[0] for row in cursor.fetchall()]
-        connection.close()
-        print(f"Symbols: {symbols}")
+        symbols = []
+    print(f"Symbols: {symbols if len(symbols) > 0 else 'all'}")
     
     # == Begin ==
     # -- In --
-    volatility = {"symbol": [], "volatility": []}
-    if __debug__:
-        print(f"Volatility init: {volatility}")
-    
-    for symbol in symbols:
-        print(f"Symbol: {symbol}")
-
-        cmd = [
-            f"SELECT close FROM ts_daily ",
-            f"WHERE symbol = '{symbol}' ",
-            f"AND (timestamp BETWEEN '{START_DATE}' AND '{END_DATE}') ",
-            f"ORDER BY timestamp ASC;"
-            ]
-        cmd = "".join(cmd)
-        if __debug__:
-            print(f"SQL: {cmd}")
-        
+    ensure_ts_daily_index(DB_FILE)
+    time_series = read_close_prices(
+        db_file = DB_FILE,
+        start_date = START_DATE,
+        end_date = END_DATE,
+        symbols = symbols)
+    print(f"Time Series: {len(time_series)} rows")
+
+    # -- PROC --
+    df = calc_volatility_batch(time_series)
+    
+    # Symbols without prices in the period get no volatility.
+    if len(symbols) == 0:
         with sqlite3.connect(DB_FILE) as connection:
-             cursor = connection.cursor()
-             cursor.execute(cmd)
-             connection.commit()
-             time_series = [row[0] for row in cursor.fetchall()]
-        print(f"Time Series: {time_series}")
+            all_symbols = [row[0] for row in connection.execute("SELECT DISTINCT symbol FROM ts_daily;")]
         connection.close()
+        df = df.set_index("symbol").reindex(all_symbols).reset_index()
 
-        # -- PROC --
-        volatility["symbol"].append(symbol)
-        try:
-            volatility["volatility"].append(calc_volatility(data = time_series))
-        except:
-            volatility["volatility"].append(np.nan)
-        if __debug__:
-            print(f"Volatility: {volatility}")
-            time.sleep(3)
-
-    df = pd.DataFrame(data = volatility)
     df.sort_values("volatility", ascending = False, inplace = True)
     print(f"Volatility Dataframe Head:\n {df.head()}")
     print(f"Volatility Dataframe Tail:\n {df.tail()}")
@@ -132,10 +264,7 @@ if __name__ == "__main__":
     df.to_csv(os.path.join(OUT_DIR, OUT_FILE), index = False)
     
     # Database.
-    with sqlite3.connect(DB_FILE) as connection:
-        result = df.to_sql("t_volatility", connection, if_exists = "replace", index = False)
-    connection.close()
+    write_volatility(DB_FILE, df)
     # == End ==
 
 # EOF .
-
@@ -6,7 +6,7 @@ __program__     = btc_daily_prices.py
 __author__      = "Georg Maubach"
 __authors__     = "Georg Maubach"
 __copyright__   = "(C)opyright 2022, The Algorithmic Stock Trading Project"
-__credits__     = ["Boris Verkhovskiy", "Black Badger", "Gifted Grebe", "Zach Bobbitt", "congusbongus", "cs95", "Data Science Parichay"] 
+__credits__     = ["Boris Verkhovskiy", "Black Badger", "Gifted Grebe", "Zach Bobbitt", "congusbongus", "cs95", "Data Science Parichay", "Howard Hinnant"] 
 __license__     = "GPL"
 __maintainer__  = "Georg Maubach"
 __contact__     = "g.maubach@gmx.de"
@@ -21,17 +21,30 @@ __interpreter__ = "Python 3.8.10"
 #=== USES ===
 
 #--- Standard ---
+from abc import ABC, abstractmethod
+import asyncio
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import partial
+from itertools import groupby
+import hashlib
 from io import BytesIO
-from typing import Final
+import json
+import os
+import tempfile
+from typing import BinaryIO, Final, Iterator
 from pathlib import Path
-import requests
-from zipfile import ZipFile
+import resource
+import shutil
+from zipfile import ZipFile, is_zipfile
 
 #--- 3rd Party ---
+import numpy as np
 import pandas as pd
 import parquet
 
 #--- MyOwn ---
+from http_client import HttpClient
 
 #=== CONST ===
 
@@ -40,47 +53,807 @@ END_DATE: Final[str] = "2022-05-31"
 
 TABLE_HEADER: Final[tuple] = (
     "time_open_unix", "price_open", "price_high", "price_low", "price_close",
-    "volume", "time_close_unix", "quote_asset_volume", "base_asset_volume",
-    "ignore"
+    "volume", "time_close_unix", "quote_asset_volume", "number_of_trades",
+    "taker_buy_base_asset_volume", "taker_buy_quote_asset_volume", "ignore"
+    )
+
+TABLE_DTYPES: Final[dict] = {
+    "time_open_unix": "int64",
+    "price_open": "float64",
+    "price_high": "float64",
+    "price_low": "float64",
+    "price_close": "float64",
+    "volume": "float64",
+    "time_close_unix": "int64",
+    "quote_asset_volume": "float64",
+    "number_of_trades": "int64",
+    "taker_buy_base_asset_volume": "float64",
+    "taker_buy_quote_asset_volume": "float64",
+    "ignore": "int64"
+    }
+
+MAX_CONCURRENCY: Final[int] = 8
+
+BINANCE_DOMAIN: Final[str] = "https://data.binance.vision/data/spot/daily/klines/"
+
+INTERVAL_MS: Final[dict] = {
+    "1s": 1_000,
+    "1m": 60_000,
+    "3m": 180_000,
+    "5m": 300_000,
+    "15m": 900_000,
+    "30m": 1_800_000,
+    "1h": 3_600_000,
+    "2h": 7_200_000,
+    "4h": 14_400_000,
+    "6h": 21_600_000,
+    "8h": 28_800_000,
+    "12h": 43_200_000,
+    "1d": 86_400_000
+    }
+
+DAY_MS: Final[int] = 86_400_000
+
+CALENDAR_FIELDS: Final[tuple] = ("year", "month", "day", "hour", "minute")
+CALENDAR_COLUMNS: Final[tuple] = (
+    "time_open_readable", "time_close_readable",
+    "time_open_year", "time_open_month", "time_open_day", "time_open_hour", "time_open_minute",
+    "time_close_year", "time_close_month", "time_close_day", "time_close_hour", "time_close_minute"
     )
     
 DATA_DIR: Final[str] = "/home/gmaubach/Programming/the-algorithmic-stock-trading-project/data/"
+CACHE_DIR: Final[str] = DATA_DIR + "cache/"
+CACHE_MAX_BYTES: Final[int] = 2 * 1024**3
+
+STORE_DIR: Final[str] = DATA_DIR + "binance/"
+
+CHUNK_BYTES: Final[int] = 1024**2
+CHUNK_ROWS: Final[int] = 100_000
+
+MAX_DECIMALS: Final[int] = 8
+
+RESOLUTIONS: Final[tuple] = ("5m", "15m", "1h", "4h", "1d")
+
+HORIZONS: Final[tuple] = (1, 5, 10)
+
+OHLCV_AGGREGATIONS: Final[dict] = {
+    "price_open": "first",
+    "price_high": "max",
+    "price_low": "min",
+    "price_close": "last",
+    "volume": "sum",
+    "quote_asset_volume": "sum",
+    "number_of_trades": "sum",
+    "taker_buy_base_asset_volume": "sum",
+    "taker_buy_quote_asset_volume": "sum"
+    }
 
 #=== VAR ===
 
+# Copy-on-Write lets derived frames share the buffers of their input without
+# ever writing back to it. It is always enabled from pandas 3.0 on.
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
+
+HTTP_CLIENT = HttpClient(pool_size = 2 * MAX_CONCURRENCY)
+
 #=== CLASS ===
 
+class BinanceSource(ABC):
+    # Place the kline archives of one symbol and interval are read from. The
+    # domain is the URL or directory that holds them. Subclasses implement
+    # checksum() and iter_blocks(), an incomplete one cannot be created.
+
+    cacheable = False
+
+    def __init__(self, domain: str):
+        self.domain = domain
+
+    def __repr__(self) -> str:
+        return(f"{type(self).__name__}({self.domain!r})")
+
+    @abstractmethod
+    def checksum(self, filename: str) -> str:
+        pass
+
+    @abstractmethod
+    def iter_blocks(self, filename: str) -> Iterator[bytes]:
+        pass
+
+    def open(self, filename: str) -> BinaryIO:
+        # Spill to disk above CHUNK_BYTES to keep large archives out of memory
+        archive = tempfile.SpooledTemporaryFile(max_size = CHUNK_BYTES)
+        for block in self.iter_blocks(filename):
+            archive.write(block)
+        archive.seek(0)
+        return(archive)
+
+    def read(self, filename: str) -> bytes:
+        return(b"".join(self.iter_blocks(filename)))
+
+class BinanceHttpSource(BinanceSource):
+    # data.binance.vision or any web server with the same layout. All sources
+    # share the pooled connections and retries of HTTP_CLIENT by default.
+
+    cacheable = True
+
+    def __init__(self, domain: str, client: HttpClient = None):
+        super().__init__(domain)
+        self.client = HTTP_CLIENT if client is None else client
+
+    def checksum(self, filename: str) -> str:
+        # "<sha256>  <filename>" is published next to each archive
+        response = self.client.get(self.domain + filename + ".CHECKSUM")
+        return(response.text.split()[0].lower())
+
+    def iter_blocks(self, filename: str) -> Iterator[bytes]:
+        url = self.domain + filename
+        print("URL of Zipfile: ", repr(url))
+        # Broken transfers are resumed, so one timeout does not lose a day
+        yield from self.client.iter_content(url, chunk_size = CHUNK_BYTES)
+
+class BinanceLocalSource(BinanceSource):
+    # Local mirror of the public-data tree, e.g. on a NAS, or a flat directory
+    # like data/ holding archives and unpacked CSV files side by side. Reading
+    # it is as fast as the disk, so it is not cached.
+
+    def path(self, filename: str) -> str:
+        # The archive itself or, failing that, its unpacked CSV file
+        for name in (filename, os.path.splitext(filename)[0] + ".csv"):
+            file = os.path.join(self.domain, name)
+            if os.path.isfile(file):
+                return(file)
+        raise FileNotFoundError(os.path.join(self.domain, filename))
+
+    def checksum(self, filename: str) -> str:
+        file = os.path.join(self.domain, filename + ".CHECKSUM")
+        if os.path.isfile(file):
+            with open(file, "r") as f:
+                return(f.read().split()[0].lower())
+        return(hash_file(file = self.path(filename)))
+
+    def iter_blocks(self, filename: str) -> Iterator[bytes]:
+        with open(self.path(filename), "rb") as f:
+            yield from iter(partial(f.read, CHUNK_BYTES), b"")
+
+    def open(self, filename: str) -> BinaryIO:
+        return(open(self.path(filename), "rb"))
+
+@pd.api.extensions.register_dataframe_accessor("calendar")
+class BinanceCalendarAccessor:
+    # Calendar fields of time_open_unix and time_close_unix, computed on first
+    # access and cached with the frame instead of being stored as columns,
+    # e.g. data.calendar["time_close_hour"]. A stored column of the same name
+    # takes precedence, so consumers work with lazy and prepared frames alike.
+
+    def __init__(self, data: pd.DataFrame):
+        self._data = data
+        self._cache = {}
+
+    def __getitem__(self, name: str) -> pd.Series:
+        if name in self._data.columns:
+            return(self._data[name])
+        if name not in self._cache:
+            column, field = name.rsplit("_", 1)
+            values = self._data[column + "_unix"].to_numpy()
+            if field == "readable":
+                self._cache[name] = pd.Series(
+                    (values // 1000).astype("datetime64[s]"),
+                    index = self._data.index,
+                    name = name)
+            elif field in CALENDAR_FIELDS:
+                # One kernel call yields all fields of the column at once
+                for key, array in decompose_epoch_ms(values = values).items():
+                    self._cache[f"{column}_{key}"] = pd.Series(
+                        array,
+                        index = self._data.index,
+                        name = f"{column}_{key}")
+            else:
+                raise KeyError(name)
+        return(self._cache[name])
+
+    def frame(self, names: tuple = CALENDAR_COLUMNS) -> pd.DataFrame:
+        return(pd.concat([self[name] for name in names], axis = 1))
+
+class OhlcvResampler:
+    # Keeps OHLCV bars of several resolutions up to date while 1m bars are
+    # appended. Finished bars are kept as they are, only the last bar of each
+    # resolution may still change. An update costs O(new bars), history is
+    # never aggregated again.
+
+    def __init__(self, interval: str = "1m", resolutions: tuple = RESOLUTIONS):
+        self.interval = interval
+        self.resolutions = tuple(resolutions)
+        self.last_time_open = None
+        self._closed = {resolution: [] for resolution in self.resolutions}
+        self._open = {resolution: None for resolution in self.resolutions}
+
+    def update(self, data: pd.DataFrame) -> dict:
+        # Returns the bars of each resolution that were added or changed
+        if len(data) == 0:
+            return({resolution: self._open[resolution] for resolution in self.resolutions})
+        if self.last_time_open is not None and data["time_open_unix"].iloc[0] <= self.last_time_open:
+            raise ValueError("Bars must be appended in time order without overlap!")
+        self.last_time_open = data["time_open_unix"].iloc[-1]
+
+        changed = {}
+        bars = resample_binance_prices(
+            data = data,
+            interval = self.interval,
+            resolutions = self.resolutions)
+        for resolution, new in bars.items():
+            last = self._open[resolution]
+            if last is not None and last["time_open_unix"].iloc[0] == new["time_open_unix"].iloc[0]:
+                new = pd.concat([merge_ohlcv(first = last, second = new.iloc[:1]), new.iloc[1:]], ignore_index = True)
+            elif last is not None:
+                self._closed[resolution].append(last)
+            if len(new) > 1:
+                self._closed[resolution].append(new.iloc[:-1])
+            self._open[resolution] = new.iloc[-1:].reset_index(drop = True)
+            changed[resolution] = new
+        return(changed)
+
+    def bars(self, resolution: str) -> pd.DataFrame:
+        frames = self._closed[resolution] + [self._open[resolution]]
+        frames = [frame for frame in frames if frame is not None]
+        if len(frames) == 0:
+            return(pd.DataFrame())
+        # Collapse the finished pieces so later calls stay cheap
+        self._closed[resolution] = [pd.concat(frames[:-1], ignore_index = True)] if len(frames) > 1 else []
+        df = pd.concat(frames, ignore_index = True)
+        df.index.name = "serial"
+        return(df)
+
+class TradingZoneMonitor:
+    # Online version of the trading zones of analyse_binance_prices(). Bars
+    # come in one at a time or in micro-batches. Only the buckets still open
+    # are kept, a bucket is emitted once a bar of a later bucket arrives. A
+    # late bar for an emitted bucket opens it again and it is emitted anew.
+
+    def __init__(self, interval: str = "1h"):
+        self.interval_ms = INTERVAL_MS[interval]
+        self.current = None
+        self._zones = {}
+
+    def update(self, bars) -> pd.DataFrame:
+        # bars is a frame, or a single bar as a dict or Series, with
+        # time_close_unix and price_close. Returns the zones closed by it.
+        if isinstance(bars, pd.DataFrame):
+            time_close = bars["time_close_unix"].to_numpy(dtype = np.int64)
+            price_close = bars["price_close"].to_numpy(dtype = np.float64)
+        else:
+            time_close = np.array([bars["time_close_unix"]], dtype = np.int64)
+            price_close = np.array([bars["price_close"]], dtype = np.float64)
+        if len(time_close) == 0:
+            return(self.emit(buckets = []))
+
+        buckets = time_close - time_close % self.interval_ms
+        order = np.argsort(buckets, kind = "stable")
+        buckets = buckets[order]
+        price_close = price_close[order]
+        starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+        highs = np.maximum.reduceat(price_close, starts)
+        lows = np.minimum.reduceat(price_close, starts)
+
+        for bucket, high, low in zip(buckets[starts].tolist(), highs.tolist(), lows.tolist()):
+            zone = self._zones.get(bucket)
+            if zone is None:
+                self._zones[bucket] = [high, low]
+            else:
+                zone[0] = max(zone[0], high)
+                zone[1] = min(zone[1], low)
+        self.current = int(buckets[-1]) if self.current is None else max(self.current, int(buckets[-1]))
+
+        return(self.emit(buckets = [bucket for bucket in self._zones if bucket < self.current]))
+
+    def flush(self) -> pd.DataFrame:
+        # Emits the open buckets as well, e.g. at the end of a session
+        return(self.emit(buckets = list(self._zones)))
+
+    def emit(self, buckets: list) -> pd.DataFrame:
+        buckets = sorted(buckets)
+        zones = [self._zones.pop(bucket) for bucket in buckets]
+        return(build_trading_zones(
+            buckets = np.array(buckets, dtype = np.int64),
+            price_close_max = np.array([zone[0] for zone in zones], dtype = np.float64),
+            price_close_min = np.array([zone[1] for zone in zones], dtype = np.float64)))
+
+class RangeMinMaxIndex:
+    # Sparse tables over price_high, price_low and price_close of a series,
+    # built once in O(n log n). Level k holds the max or min of the 2^k bars
+    # starting at each bar, so any range is covered by two overlapping
+    # entries of one level: a query costs O(1) after a binary search for the
+    # timestamps *25. Appended bars extend every level in place, which costs
+    # O(log n) per bar plus amortised buffer growth.
+
+    TABLES = (
+        ("price_high", "max"),
+        ("price_low", "min"),
+        ("price_close", "max"),
+        ("price_close", "min")
+        )
+
+    def __init__(self, data: pd.DataFrame = None):
+        self.length = 0
+        self._capacity = 0
+        self._times = np.empty(0, dtype = np.int64)
+        self._levels = {table: [] for table in self.TABLES}
+        if data is not None:
+            self.append(data)
+
+    def _reserve(self, length: int) -> None:
+        if length <= self._capacity:
+            return(None)
+        self._capacity = max(length, 2 * self._capacity)
+        times = np.empty(self._capacity, dtype = np.int64)
+        times[:self.length] = self._times[:self.length]
+        self._times = times
+        for levels in self._levels.values():
+            for k, level in enumerate(levels):
+                grown = np.empty(self._capacity, dtype = np.float64)
+                grown[:max(0, self.length - (1 << k) + 1)] = level[:max(0, self.length - (1 << k) + 1)]
+                levels[k] = grown
+        return(None)
+
+    def append(self, data: pd.DataFrame) -> None:
+        times = data["time_open_unix"].to_numpy(dtype = np.int64)
+        if len(times) == 0:
+            return(None)
+        if np.any(np.diff(times) <= 0) or (self.length > 0 and times[0] <= self._times[self.length - 1]):
+            raise ValueError("Bars must be appended in strictly increasing time order!")
+
+        old_length = self.length
+        length = old_length + len(times)
+        self._reserve(length)
+        self._times[old_length:length] = times
+
+        for (column, how), levels in self._levels.items():
+            combine = np.maximum if how == "max" else np.minimum
+            if len(levels) == 0:
+                levels.append(np.empty(self._capacity, dtype = np.float64))
+            levels[0][old_length:length] = data[column].to_numpy(dtype = np.float64)
+            k = 1
+            while (1 << k) <= length:
+                if k == len(levels):
+                    levels.append(np.empty(self._capacity, dtype = np.float64))
+                half = 1 << (k - 1)
+                start = max(0, old_length - (1 << k) + 1)
+                stop = length - (1 << k) + 1
+                combine(levels[k - 1][start:stop], levels[k - 1][start + half:stop + half], out = levels[k][start:stop])
+                k += 1
+
+        self.length = length
+        return(None)
+
+    def query(self, start, end) -> pd.DataFrame:
+        # Ranges of the bars opened between start and end, both inclusive and
+        # given in epoch milliseconds. Scalars or arrays of equal length.
+        starts = np.atleast_1d(np.asarray(start, dtype = np.int64))
+        ends = np.atleast_1d(np.asarray(end, dtype = np.int64))
+        times = self._times[:self.length]
+        first = np.searchsorted(times, starts, side = "left")
+        last = np.searchsorted(times, ends, side = "right") - 1
+        valid = first <= last
+        # Exponent of the largest power of two not above the range width
+        k = np.frexp(np.where(valid, last - first + 1, 1))[1] - 1
+
+        columns = {}
+        for (column, how), levels in self._levels.items():
+            combine = np.maximum if how == "max" else np.minimum
+            values = np.full(len(starts), np.nan)
+            for level in np.unique(k[valid]):
+                rows = valid & (k == level)
+                values[rows] = combine(
+                    levels[level][first[rows]],
+                    levels[level][last[rows] - (1 << level) + 1])
+            columns[f"{column}_{how}"] = values
+
+        df = pd.DataFrame(columns)
+        df["high_low_abs"] = df["price_high_max"] - df["price_low_min"]
+        df["high_low_pct"] = df["high_low_abs"]*100/df["price_low_min"]
+        df["close_high_low_abs"] = df["price_close_max"] - df["price_close_min"]
+        df["close_high_low_pct"] = df["close_high_low_abs"]*100/df["price_close_min"]
+        return(df)
+
 #=== FUNCTION ===
 
+def get_binance_source(
+    domain: str = "https://data.binance.vision/data/spot/daily/klines/BTCBUSD/1m/") -> BinanceSource:
+    if __debug__: print("START: get_binance_source()")
+
+    # A URL is read over HTTP, anything else is a local directory
+    if domain.startswith(("http://", "https://")):
+        source = BinanceHttpSource(domain)
+    else:
+        source = BinanceLocalSource(domain)
+
+    if __debug__: print("END: get_binance_source()")
+    return(source)
+
 def get_binance_hist_prices(
     domain: str = "https://data.binance.vision/data/spot/daily/klines/BTCBUSD/1m/",
     base: str = "BTCBUSD-1m-",
     date: str = START_DATE,
-    suffix: str = ".zip") -> pd.DataFrame:
+    suffix: str = ".zip",
+    cache_dir: str = CACHE_DIR) -> pd.DataFrame:
     if __debug__: print("START: get_binance_hist_prices()")
 
-    # Download from web
-    url = domain + base + date + suffix
-    print("URL of Zipfile: ", repr(url))
+    content = download_binance_archive(
+        domain = domain,
+        base = base,
+        date = date,
+        suffix = suffix,
+        cache_dir = cache_dir)
+
+    df = unzip_binance_prices(content = content)
+
+    if __debug__: print("END: get_binance_hist_prices()")
+    return(df)
+
+def download_binance_archive(
+    domain: str = "https://data.binance.vision/data/spot/daily/klines/BTCBUSD/1m/",
+    base: str = "BTCBUSD-1m-",
+    date: str = START_DATE,
+    suffix: str = ".zip",
+    cache_dir: str = CACHE_DIR) -> bytes:
+    if __debug__: print("START: download_binance_archive()")
+
+    # Read from the source unless the archive is already in the local cache
+    source = get_binance_source(domain = domain)
+    if cache_dir is None or not source.cacheable:
+        content = source.read(base + date + suffix)
+    else:
+        content = get_binance_archive(
+            domain = domain,
+            base = base,
+            date = date,
+            suffix = suffix,
+            cache_dir = cache_dir)
+
+    if __debug__: print("END: download_binance_archive()")
+    return(content)
+
+def download_binance_archives(
+    domain: str = "https://data.binance.vision/data/spot/monthly/klines/BTCBUSD/1m/",
+    base: str = "BTCBUSD-1m-",
+    date: str = START_DATE,
+    suffix: str = ".zip",
+    cache_dir: str = CACHE_DIR) -> list:
+    if __debug__: print("START: download_binance_archives()")
+
+    # Same as download_binance_archive() but a monthly archive that is not
+    # published yet is replaced by the daily archives of its month. A day that
+    # fails there is returned with its exception in place of the content, as
+    # gather(return_exceptions = True) does, so the other days are kept.
+    try:
+        archives = [(date, download_binance_archive(
+            domain = domain,
+            base = base,
+            date = date,
+            suffix = suffix,
+            cache_dir = cache_dir))]
+    except Exception:
+        if "/monthly/" not in domain:
+            raise
+        period = pd.Period(date, freq = "M")
+        dates = generate_day_sequence(
+            start_date = period.start_time.strftime("%Y-%m-%d"),
+            end_date = period.end_time.strftime("%Y-%m-%d"))
+        archives = []
+        for day in dates:
+            try:
+                archives.append((day, download_binance_archive(
+                    domain = domain.replace("/monthly/", "/daily/"),
+                    base = base,
+                    date = day,
+                    suffix = suffix,
+                    cache_dir = cache_dir)))
+            except Exception as e:
+                archives.append((day, e))
+
+    if __debug__: print("END: download_binance_archives()")
+    return(archives)
+
+def get_binance_archive(
+    domain: str = "https://data.binance.vision/data/spot/daily/klines/BTCBUSD/1m/",
+    base: str = "BTCBUSD-1m-",
+    date: str = START_DATE,
+    suffix: str = ".zip",
+    cache_dir: str = CACHE_DIR,
+    seed_dir: str = DATA_DIR,
+    max_cache_bytes: int = CACHE_MAX_BYTES) -> bytes:
+    if __debug__: print("START: get_binance_archive()")
+
+    file = get_binance_archive_file(
+        domain = domain,
+        base = base,
+        date = date,
+        suffix = suffix,
+        cache_dir = cache_dir,
+        seed_dir = seed_dir,
+        max_cache_bytes = max_cache_bytes)
+
+    with open(file, "rb") as f:
+        content = f.read()
+
+    if __debug__: print("END: get_binance_archive()")
+    return(content)
+
+def get_binance_archive_file(
+    domain: str = "https://data.binance.vision/data/spot/daily/klines/BTCBUSD/1m/",
+    base: str = "BTCBUSD-1m-",
+    date: str = START_DATE,
+    suffix: str = ".zip",
+    cache_dir: str = CACHE_DIR,
+    seed_dir: str = DATA_DIR,
+    max_cache_bytes: int = CACHE_MAX_BYTES) -> str:
+    if __debug__: print("START: get_binance_archive_file()")
+
+    # Archives are stored content-addressed under objects/<sha256>.zip. The key
+    # <path>/filename.CHECKSUM holds the hash in the Binance format. The path
+    # is the one of domain below the data root, e.g. spot/daily/klines/BTCBUSD/1m,
+    # so markets sharing symbol, interval and date never share a key. Other
+    # domains are told apart by a hash.
+    filename = base + date + suffix
+    source = get_binance_source(domain = domain)
+    _, root, path = domain.rpartition("/data/")
+    key_dir = path.strip("/") if root else hashlib.sha256(domain.encode()).hexdigest()[:16]
+    key_file = os.path.join(cache_dir, *key_dir.split("/"), filename + ".CHECKSUM")
+    object_dir = os.path.join(cache_dir, "objects")
+
+    # Cache hit: no network access at all
+    if os.path.isfile(key_file):
+        with open(key_file, "r") as f:
+            checksum = f.read().split()[0]
+        object_file = os.path.join(object_dir, checksum + suffix)
+        if os.path.isfile(object_file):
+            if hash_file(file = object_file) == checksum:
+                os.utime(object_file)
+                print(f"Cache hit: {filename}")
+                if __debug__: print("END: get_binance_archive_file()")
+                return(object_file)
+            print(f"Checksum mismatch in cache: {filename}")
+
+    # Cache miss: take the archive from seed_dir or the source and verify it.
+    # It is written to a temporary file first so concurrent readers never see
+    # a partially written archive.
+    checksum = source.checksum(filename)
+    os.makedirs(object_dir, exist_ok = True)
+    os.makedirs(os.path.dirname(key_file), exist_ok = True)
+    fd, temp_file = tempfile.mkstemp(dir = object_dir)
+    with os.fdopen(fd, "wb") as f:
+        seed_file = os.path.join(seed_dir, filename)
+        if os.path.isfile(seed_file) and hash_file(file = seed_file) == checksum:
+            with open(seed_file, "rb") as seed:
+                shutil.copyfileobj(seed, f, CHUNK_BYTES)
+        else:
+            if os.path.isfile(seed_file):
+                print(f"Checksum mismatch in {seed_dir}: {filename}")
+            sha256 = hashlib.sha256()
+            for block in source.iter_blocks(filename):
+                sha256.update(block)
+                f.write(block)
+            if sha256.hexdigest() != checksum:
+                f.close()
+                os.remove(temp_file)
+                raise ValueError(f"Checksum mismatch for {domain + filename}")
+    object_file = os.path.join(object_dir, checksum + suffix)
+    os.replace(temp_file, object_file)
+    fd, temp_file = tempfile.mkstemp(dir = os.path.dirname(key_file))
+    with os.fdopen(fd, "w") as f:
+        f.write(f"{checksum}  {filename}\n")
+    os.replace(temp_file, key_file)
+
+    evict_binance_cache(
+        cache_dir = cache_dir,
+        max_cache_bytes = max_cache_bytes,
+        keep = (object_file,))
+
+    if __debug__: print("END: get_binance_archive_file()")
+    return(object_file)
 
-    content = requests.get(url)
+def hash_file(
+    file: str) -> str:
+    if __debug__: print("START: hash_file()")
 
-    z = ZipFile(BytesIO(content.content))
+    sha256 = hashlib.sha256()
+    with open(file, "rb") as f:
+        for block in iter(partial(f.read, CHUNK_BYTES), b""):
+            sha256.update(block)
+
+    if __debug__: print("END: hash_file()")
+    return(sha256.hexdigest())
+
+def evict_binance_cache(
+    cache_dir: str = CACHE_DIR,
+    max_cache_bytes: int = CACHE_MAX_BYTES,
+    keep: tuple = ()) -> None:
+    if __debug__: print("START: evict_binance_cache()")
+
+    # Least recently used archives go first. Their key files are left behind
+    # and simply turn into cache misses. Archives in keep, e.g. the one just
+    # fetched, stay even if they alone exceed max_cache_bytes. Only archives
+    # named <sha256><suffix> are considered, temporary files of downloads in
+    # progress are left alone.
+    object_dir = os.path.join(cache_dir, "objects")
+    keep = {os.path.abspath(file) for file in keep}
+    objects = sorted(
+        (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+        for entry in os.scandir(object_dir)
+        if entry.is_file()
+        and len(entry.name.split(".")[0]) == 64
+        and all(c in "0123456789abcdef" for c in entry.name.split(".")[0]))
+    total_bytes = sum(size for _, size, _ in objects)
+
+    for _, size, path in objects:
+        if total_bytes <= max_cache_bytes:
+            break
+        if os.path.abspath(path) in keep:
+            continue
+        try:
+            os.remove(path)
+            total_bytes -= size
+        except FileNotFoundError:
+            pass
+
+    if __debug__: print("END: evict_binance_cache()")
+    return(None)
+
+def unzip_binance_prices(
+    content: bytes) -> pd.DataFrame:
+    if __debug__: print("START: unzip_binance_prices()")
+
+    # A local source may hand out an unpacked CSV file instead of an archive
+    if not is_zipfile(BytesIO(content)):
+        df = read_binance_klines(file = BytesIO(content))
+        if __debug__: print("END: unzip_binance_prices()")
+        return(df)
+
+    z = ZipFile(BytesIO(content))
     print(f"Files in ZipFile: {z.namelist()}")
 
     # Unzip content on the fly in memory
     with z.open(z.namelist()[0], 'r') as f:
-        df = pd.read_csv(
+        df = read_binance_klines(file = f)
+
+    if __debug__: print("END: unzip_binance_prices()")
+    return(df)
+
+def read_binance_klines(
+    file) -> pd.DataFrame:
+    if __debug__: print("START: read_binance_klines()")
+
+    # Fixed schema instead of type inference. The pyarrow engine parses the
+    # blocks of the file in parallel threads.
+    df = pd.read_csv(
+        file,
+        header = None,
+        names = TABLE_HEADER,
+        dtype = TABLE_DTYPES,
+        engine = "pyarrow"
+        )
+
+    df.index.name = "serial"
+
+    if __debug__: print("END: read_binance_klines()")
+    return(df)
+
+def iter_binance_prices(
+    domain: str = "https://data.binance.vision/data/spot/daily/klines/BTCBUSD/1m/",
+    base: str = "BTCBUSD-1m-",
+    date: str = START_DATE,
+    suffix: str = ".zip",
+    cache_dir: str = CACHE_DIR,
+    chunksize: int = CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+    if __debug__: print("START: iter_binance_prices()")
+
+    # The compressed archive is kept on disk, either in the cache, in a local
+    # source or in a temporary file that spills to disk above CHUNK_BYTES.
+    # Only one chunk of decompressed and parsed rows is held in memory at a
+    # time.
+    source = get_binance_source(domain = domain)
+    if cache_dir is None or not source.cacheable:
+        archive = source.open(base + date + suffix)
+    else:
+        archive = open(get_binance_archive_file(
+            domain = domain,
+            base = base,
+            date = date,
+            suffix = suffix,
+            cache_dir = cache_dir), "rb")
+
+    with ExitStack() as stack:
+        f = stack.enter_context(archive)
+        if is_zipfile(f):
+            z = stack.enter_context(ZipFile(f))
+            f = stack.enter_context(z.open(z.namelist()[0], 'r'))
+        else:
+            f.seek(0)
+        reader = pd.read_csv(
             f,
             header = None,
             names = TABLE_HEADER,
-            index_col = False
+            dtype = TABLE_DTYPES,
+            chunksize = chunksize
             )
+        for chunk in reader:
+            chunk.index.name = "serial"
+            yield chunk
 
-    df.index.name = "serial"
+    if __debug__: print("END: iter_binance_prices()")
 
-    if __debug__: print("END: get_binance_hist_prices()")
-    return(df)
+async def get_binance_hist_prices_async(
+    archives: list,
+    base: str = "BTCBUSD-1m-",
+    suffix: str = ".zip",
+    cache_dir: str = CACHE_DIR,
+    max_concurrency: int = MAX_CONCURRENCY) -> tuple:
+    if __debug__: print("START: get_binance_hist_prices_async()")
+
+    # The blocking download and unzip of get_binance_hist_prices() run in a
+    # thread pool, so at most max_concurrency archives are in flight at once.
+    loop = asyncio.get_running_loop()
+
+    with ThreadPoolExecutor(max_workers = max_concurrency) as executor:
+        tasks = [
+            loop.run_in_executor(
+                executor,
+                partial(
+                    get_binance_hist_prices,
+                    domain = domain,
+                    base = base,
+                    date = date,
+                    suffix = suffix,
+                    cache_dir = cache_dir))
+            for domain, date in archives
+            ]
+        results = await asyncio.gather(*tasks, return_exceptions = True)
+
+    # gather() keeps the order of archives, not the order of completion
+    frames = {}
+    failures = {}
+    for (domain, date), result in zip(archives, results):
+        if isinstance(result, Exception):
+            failures[date] = repr(result)
+        else:
+            frames[date] = result
+
+    if __debug__: print("END: get_binance_hist_prices_async()")
+    return((frames, failures))
+
+def get_binance_hist_prices_batch(
+    archives: list,
+    base: str = "BTCBUSD-1m-",
+    suffix: str = ".zip",
+    cache_dir: str = CACHE_DIR,
+    max_concurrency: int = 1) -> tuple:
+    if __debug__: print("START: get_binance_hist_prices_batch()")
+
+    if max_concurrency > 1:
+        frames, failures = asyncio.run(
+            get_binance_hist_prices_async(
+                archives = archives,
+                base = base,
+                suffix = suffix,
+                cache_dir = cache_dir,
+                max_concurrency = max_concurrency))
+    else:
+        frames = {}
+        failures = {}
+
+        for domain, date in archives:
+            try:
+                frames[date] = get_binance_hist_prices(
+                    domain = domain,
+                    base = base,
+                    date = date,
+                    suffix = suffix,
+                    cache_dir = cache_dir)
+            except Exception as e:
+                failures[date] = repr(e)
+
+    if __debug__: print("END: get_binance_hist_prices_batch()")
+    return((frames, failures))
 
 def generate_day_sequence(
     start_date: str = START_DATE,
@@ -94,91 +867,461 @@ def generate_day_sequence(
     if __debug__: print("END: generate_day_sequence()")
     return(dates)
 
+def plan_binance_archives(
+    domain: str = "https://data.binance.vision/data/spot/daily/klines/BTCBUSD/1m/",
+    start_date: str = START_DATE,
+    end_date: str = END_DATE,
+    use_monthly: bool = True) -> list:
+    if __debug__: print("START: plan_binance_archives()")
+
+    # Binance publishes one archive per month next to the daily archives.
+    # Months fully covered by the range use the monthly archive, the partial
+    # months at the edges and the running month fall back to daily archives.
+    monthly_domain = domain.replace("/daily/", "/monthly/")
+    current_month = pd.Timestamp.now(tz = "UTC").tz_localize(None).to_period("M")
+    start = pd.Timestamp(start_date)
+    end = pd.Timestamp(end_date)
+
+    archives = []
+    for month in pd.period_range(start = start, end = end, freq = "M"):
+        first = max(start, month.start_time)
+        last = min(end, month.end_time.normalize())
+        if (use_monthly and
+            monthly_domain != domain and
+            month < current_month and
+            first == month.start_time and
+            last == month.end_time.normalize()):
+            archives.append((monthly_domain, month.strftime("%Y-%m")))
+        else:
+            dates = generate_day_sequence(
+                start_date = first.strftime("%Y-%m-%d"),
+                end_date = last.strftime("%Y-%m-%d"))
+            archives.extend((domain, date) for date in dates)
+
+    if __debug__: print("END: plan_binance_archives()")
+    return(archives)
+
+def assemble_binance_prices(
+    frames: list) -> pd.DataFrame:
+    if __debug__: print("START: assemble_binance_prices()")
+
+    # Concatenate the daily frames column by column and build the result once.
+    # Growing a frame day by day copies everything collected so far on each
+    # step, which is quadratic in the number of days.
+    if len(frames) == 0:
+        columns = {name: [] for name in TABLE_HEADER}
+    else:
+        columns = {
+            name: np.concatenate([frame[name].to_numpy() for frame in frames])
+            for name in frames[0].columns
+            }
+
+    df = pd.DataFrame(columns)
+    df.index.name = "serial"
+
+    if __debug__: print("END: assemble_binance_prices()")
+    return(df)
+
+def compact_binance_prices(
+    data: pd.DataFrame,
+    max_decimals: int = MAX_DECIMALS) -> pd.DataFrame:
+    if __debug__: print("START: compact_binance_prices()")
+
+    # Floats become integers scaled by the smallest power of ten that restores
+    # them exactly, or float32 if that is exact and smaller. Integers get the
+    # smallest type that holds them, constant columns are dropped and strings
+    # become categories. Everything needed to undo this goes to
+    # attrs["compact_schema"] for expand_binance_prices().
+    schema = {
+        "columns": list(data.columns),
+        "dtypes": {name: str(dtype) for name, dtype in data.dtypes.items()},
+        "scales": {},
+        "constants": {}
+        }
+    columns = {}
+
+    for name in data.columns:
+        values = data[name].to_numpy()
+        kind = values.dtype.kind
+        if kind in "iuf" and len(values) > 0 and (values == values[0]).all():
+            schema["constants"][name] = values[0].item()
+        elif kind == "f" and not np.isnan(values).any():
+            columns[name] = values
+            for decimals in range(max_decimals + 1):
+                scaled = np.round(values * 10**decimals)
+                # Beyond int64, including inf, the cast would wrap silently
+                if not np.abs(scaled).max() < 2**63:
+                    break
+                if (scaled / 10**decimals == values).all():
+                    scaled = pd.to_numeric(scaled.astype(np.int64), downcast = "integer")
+                    columns[name] = scaled
+                    schema["scales"][name] = decimals
+                    break
+            if columns[name].dtype.itemsize > 4 and (values.astype(np.float32).astype(np.float64) == values).all():
+                columns[name] = values.astype(np.float32)
+                schema["scales"].pop(name, None)
+        elif kind in "iu":
+            downcast = "unsigned" if len(values) > 0 and values.min() >= 0 else "integer"
+            columns[name] = pd.to_numeric(values, downcast = downcast)
+            if columns[name].dtype.itemsize >= values.dtype.itemsize:
+                columns[name] = values
+        elif kind in "OUS" or isinstance(data[name].dtype, pd.StringDtype):
+            columns[name] = pd.Categorical(values)
+        else:
+            columns[name] = data[name].to_numpy()
+
+    df = pd.DataFrame(columns, index = data.index)
+    df.attrs = dict(data.attrs)
+    df.attrs["compact_schema"] = schema
+
+    if __debug__: print("END: compact_binance_prices()")
+    return(df)
+
+def expand_binance_prices(
+    data: pd.DataFrame) -> pd.DataFrame:
+    if __debug__: print("START: expand_binance_prices()")
+
+    schema = data.attrs["compact_schema"]
+    columns = {}
+
+    for name in schema["columns"]:
+        dtype = schema["dtypes"][name]
+        if name in schema["constants"]:
+            columns[name] = np.full(len(data), schema["constants"][name], dtype = dtype)
+        elif name in schema["scales"]:
+            columns[name] = data[name].to_numpy(dtype = np.float64) / 10**schema["scales"][name]
+        else:
+            columns[name] = data[name].astype(dtype)
+
+    df = pd.DataFrame(columns, index = data.index)
+    df.attrs = {key: value for key, value in data.attrs.items() if key != "compact_schema"}
+
+    if __debug__: print("END: expand_binance_prices()")
+    return(df)
+
 def get_binance_hist_price_series(
     domain: str = "https://data.binance.vision/data/spot/daily/klines/BTCBUSD/1m/",
     base: str = "BTCBUSD-1m-",
     start_date: str = START_DATE,
     end_date: str = END_DATE,
-    suffix: str = ".zip") -> pd.DataFrame:
+    suffix: str = ".zip",
+    cache_dir: str = CACHE_DIR,
+    max_concurrency: int = 1,
+    use_monthly: bool = True,
+    compact: bool = False) -> pd.DataFrame:
     if __debug__: print("START: get_binance_hist_price_series()")
 
-    dates = generate_day_sequence(
+    archives = plan_binance_archives(
+        domain = domain,
         start_date = start_date,
-        end_date = end_date)
+        end_date = end_date,
+        use_monthly = use_monthly)
+    print(f"Archives to fetch: {len(archives)}")
 
-    df = pd.DataFrame()
-    
-    for date in dates:
-        temp = get_binance_hist_prices(
-            domain = domain,
+    frames, failures = get_binance_hist_prices_batch(
+        archives = archives,
+        base = base,
+        suffix = suffix,
+        cache_dir = cache_dir,
+        max_concurrency = max_concurrency)
+
+    # A monthly archive is published a few days after the month has ended.
+    # Fetch the days of a month whose archive failed one by one instead.
+    months = [
+        date for archive_domain, date in archives
+        if date in failures and archive_domain != domain
+        ]
+    if len(months) > 0:
+        retry = []
+        for month in months:
+            del failures[month]
+            period = pd.Period(month, freq = "M")
+            dates = generate_day_sequence(
+                start_date = period.start_time.strftime("%Y-%m-%d"),
+                end_date = period.end_time.strftime("%Y-%m-%d"))
+            retry.extend((domain, date) for date in dates)
+        retry_frames, retry_failures = get_binance_hist_prices_batch(
+            archives = retry,
             base = base,
-            date = date,
-            suffix = suffix)
-        df = df.append(temp)
+            suffix = suffix,
+            cache_dir = cache_dir,
+            max_concurrency = max_concurrency)
+        frames.update(retry_frames)
+        failures.update(retry_failures)
 
-    print(f"Memory usage of dataframe {df.memory_usage().sum():,.0f} Bytes")
+    # A failed archive is reported but does not abort the batch
+    for date, error in failures.items():
+        print(f"Download failed for {date}: {error}")
+
+    # "YYYY-MM" and "YYYY-MM-DD" keys never overlap and sort chronologically
+    frames = [frames[date] for date in sorted(frames)]
+
+    df = assemble_binance_prices(frames = frames)
+    df.attrs["failed_dates"] = failures
+
+    if compact:
+        memory_usage = df.memory_usage().sum()
+        df = compact_binance_prices(data = df)
+        print(f"Memory usage of dataframe {df.memory_usage().sum():,.0f} Bytes (compact, {memory_usage:,.0f} Bytes before, {100 - df.memory_usage().sum() * 100 / memory_usage:.0f}% saved)")
+    else:
+        print(f"Memory usage of dataframe {df.memory_usage().sum():,.0f} Bytes")
+    print(f"Peak memory usage of process {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024:,.0f} Bytes")
+    print(f"HTTP latency: {HTTP_CLIENT.latency_summary()}")
 
     if __debug__: print("END: get_binance_hist_price_series()")
     return(df)
 
+def get_binance_hist_price_matrix(
+    symbols: list = ["BTCBUSD"],
+    intervals: list = ["1m"],
+    start_date: str = START_DATE,
+    end_date: str = END_DATE,
+    suffix: str = ".zip",
+    cache_dir: str = CACHE_DIR,
+    io_workers: int = MAX_CONCURRENCY,
+    parse_workers: int = os.cpu_count(),
+    use_monthly: bool = True,
+    out_dir: str = None,
+    binance_domain: str = BINANCE_DOMAIN,
+    compact: bool = False) -> pd.DataFrame:
+    if __debug__: print("START: get_binance_hist_price_matrix()")
+
+    # One job per archive of every symbol and interval
+    jobs = {}
+    for symbol in symbols:
+        for interval in intervals:
+            archives = plan_binance_archives(
+                domain = binance_domain + f"{symbol}/{interval}/",
+                start_date = start_date,
+                end_date = end_date,
+                use_monthly = use_monthly)
+            for domain, date in archives:
+                jobs[(symbol, interval, date)] = (domain, f"{symbol}-{interval}-")
+    print(f"Archives to fetch: {len(jobs)}")
+
+    # Downloads run in a thread pool. Each archive is handed to a process pool
+    # for parsing as soon as it arrives, so parsing is not capped by the GIL.
+    frames = {}
+    failures = {}
+    with ThreadPoolExecutor(max_workers = io_workers) as io_pool, \
+         ProcessPoolExecutor(max_workers = parse_workers) as parse_pool:
+        downloads = {
+            io_pool.submit(
+                download_binance_archives,
+                domain = domain,
+                base = base,
+                date = date,
+                suffix = suffix,
+                cache_dir = cache_dir): (symbol, interval, date)
+            for (symbol, interval, date), (domain, base) in jobs.items()
+            }
+        parses = {}
+        for future in as_completed(downloads):
+            symbol, interval, date = downloads[future]
+            try:
+                for archive_date, content in future.result():
+                    if isinstance(content, Exception):
+                        failures[f"{symbol}-{interval}-{archive_date}"] = repr(content)
+                        continue
+                    parses[parse_pool.submit(unzip_binance_prices, content = content)] = (symbol, interval, archive_date)
+            except Exception as e:
+                failures[f"{symbol}-{interval}-{date}"] = repr(e)
+        for future in as_completed(parses):
+            symbol, interval, date = parses[future]
+            try:
+                frames[(symbol, interval, date)] = future.result()
+            except Exception as e:
+                failures[f"{symbol}-{interval}-{date}"] = repr(e)
+
+    # A failed archive is reported but does not abort the batch
+    for archive, error in sorted(failures.items()):
+        print(f"Download failed for {archive}: {error}")
+
+    # Keys sort by symbol, interval and then chronologically by date
+    results = []
+    for (symbol, interval), keys in groupby(sorted(frames), key = lambda key: key[:2]):
+        df = assemble_binance_prices(frames = [frames.pop(key) for key in keys])
+        if out_dir is None:
+            df.insert(0, "symbol", pd.Categorical.from_codes(
+                np.full(len(df), symbols.index(symbol)), categories = symbols))
+            df.insert(1, "interval", pd.Categorical.from_codes(
+                np.full(len(df), intervals.index(interval)), categories = intervals))
+            results.append(df)
+        else:
+            if compact:
+                df = compact_binance_prices(data = df)
+            file = os.path.join(out_dir, f"binance_{symbol}_{interval}_price_series.parquet")
+            df.to_parquet(file)
+            results.append(pd.DataFrame({
+                "symbol": [symbol],
+                "interval": [interval],
+                "rows": [len(df)],
+                "file": [file]
+                }))
+
+    if len(results) > 0:
+        df = pd.concat(results, ignore_index = True)
+    else:
+        df = pd.DataFrame()
+    df.index.name = "serial"
+    df.attrs["failed_dates"] = failures
+
+    if compact and out_dir is None:
+        memory_usage = df.memory_usage().sum()
+        df = compact_binance_prices(data = df)
+        print(f"Memory usage of dataframe {df.memory_usage().sum():,.0f} Bytes (compact, {memory_usage:,.0f} Bytes before, {100 - df.memory_usage().sum() * 100 / memory_usage:.0f}% saved)")
+    else:
+        print(f"Memory usage of dataframe {df.memory_usage().sum():,.0f} Bytes")
+    print(f"Peak memory usage of process {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024:,.0f} Bytes")
+
+    if __debug__: print("END: get_binance_hist_price_matrix()")
+    return(df)
+
+def decompose_epoch_ms(
+    values: np.ndarray) -> dict:
+    if __debug__: print("START: decompose_epoch_ms()")
+
+    # Year, month, day, hour and minute of UTC epoch milliseconds in integer
+    # arithmetic, without datetime objects. Days since 1970-01-01 are mapped
+    # to the civil date by shifting the year to start on March 1st, so the
+    # leap day is the last day of a 400 year era *22.
+    seconds = np.asarray(values, dtype = np.int64) // 1000
+    days = (seconds // 86_400).astype(np.int32)
+    seconds_of_day = (seconds - days.astype(np.int64) * 86_400).astype(np.int32)
+    del seconds
+
+    z = days + 719_468
+    era = z // 146_097
+    day_of_era = z - era * 146_097
+    year_of_era = (day_of_era - day_of_era // 1_460 + day_of_era // 36_524 - day_of_era // 146_096) // 365
+    day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4 - year_of_era // 100)
+    month_shifted = (5 * day_of_year + 2) // 153
+    month = np.where(month_shifted < 10, month_shifted + 3, month_shifted - 9)
+
+    fields = {
+        "year": (year_of_era + era * 400 + (month <= 2)).astype(np.int16),
+        "month": month.astype(np.int8),
+        "day": (day_of_year - (153 * month_shifted + 2) // 5 + 1).astype(np.int8),
+        "hour": (seconds_of_day // 3_600).astype(np.int8),
+        "minute": (seconds_of_day // 60 % 60).astype(np.int8)
+        }
+
+    if __debug__: print("END: decompose_epoch_ms()")
+    return(fields)
+
 def prepare_binance_prices(
-    data: pd.DataFrame
+    data: pd.DataFrame,
+    lazy: bool = False
     ) -> pd.DataFrame:
     if __debug__: print("START: prepare_binance_prices()")
 
-    df = data # %PERF% If performance is an issue do without copying the data to a new object.
-    
+    # The shallow copy shares the buffers of data, nothing is copied. The
+    # columns added below only go to the new frame, data is left unchanged.
+    df = data.copy(deep = False)
+
     # Convert UNIX datetime with 13 digits and milliseconds into human readable format
-    df["time_open_readable"] = df["time_open_unix"].astype("datetime64[ms]").astype("datetime64[s]")
-    df["time_close_readable"] = df["time_close_unix"].astype("datetime64[ms]").astype("datetime64[s]")
-
-    # Extract year, month, day, hour, minute from datetime objects
-    # Data redundance is generated on purpose.
-    ## time_open
-    df["time_open_year"] = df["time_open_readable"].dt.year
-    df["time_open_month"] = df["time_open_readable"].dt.month
-    df["time_open_day"] = df["time_open_readable"].dt.day
-    df["time_open_hour"] = df["time_open_readable"].dt.hour
-    df["time_open_minute"] = df["time_open_readable"].dt.minute
-    ## time_close
-    df["time_close_year"] = df["time_close_readable"].dt.year
-    df["time_close_month"] = df["time_close_readable"].dt.month
-    df["time_close_day"] = df["time_close_readable"].dt.day
-    df["time_close_hour"] = df["time_close_readable"].dt.hour
-    df["time_close_minute"] = df["time_close_readable"].dt.minute
+    # and extract year, month, day, hour, minute from datetime objects.
+    # Data redundance is generated on purpose unless lazy is set. Then the
+    # fields are left to the calendar accessor and derived when first used.
+    if not lazy:
+        df[list(CALENDAR_COLUMNS)] = df.calendar.frame()
 
     print(f"Memory usage of dataframe {df.memory_usage().sum():,.0f} Bytes")
     
-    if __debug__: print("START: prepare_binance_prices()")
+    if __debug__: print("END: prepare_binance_prices()")
     return(df)
 
+def calc_return_matrix(
+    prices: np.ndarray,
+    horizons: tuple = HORIZONS,
+    dtype: type = np.float32) -> np.ndarray:
+    if __debug__: print("START: calc_return_matrix()")
+
+    # Row t, column j holds the change in percent of the price over the last
+    # horizons[j] bars: (p[t] - p[t - h]) * 100 / p[t], NaN for t < h. Every
+    # horizon is computed from shifted views of the same price buffer through
+    # one reused scratch buffer. Columns are contiguous (Fortran order), so
+    # column statistics run at full speed.
+    prices = np.asarray(prices, dtype = np.float64)
+    matrix = np.full((len(prices), len(horizons)), np.nan, dtype = dtype, order = "F")
+    scratch = np.empty(len(prices), dtype = np.float64)
+
+    for j, h in enumerate(horizons):
+        if h <= 0:
+            raise ValueError(f"Horizons must be positive, got {h}!")
+        if h >= len(prices):
+            continue
+        diff = scratch[:len(prices) - h]
+        np.subtract(prices[h:], prices[:-h], out = diff)
+        np.multiply(diff, 100, out = diff)
+        np.divide(diff, prices[h:], out = diff)
+        matrix[h:, j] = diff
+
+    if __debug__: print("END: calc_return_matrix()")
+    return(matrix)
+
+def summarise_return_matrix(
+    matrix: np.ndarray,
+    horizons: tuple = HORIZONS) -> pd.DataFrame:
+    if __debug__: print("START: summarise_return_matrix()")
+
+    # Statistics of all horizons in one table. The first h rows of a column
+    # are NaN by construction and are sliced off, so plain reductions over the
+    # contiguous rest do instead of the much slower NaN-aware ones. Further
+    # NaN only come from NaN prices and are dropped.
+    statistics = []
+    for j, h in enumerate(horizons):
+        column = matrix[min(h, len(matrix)):, j]
+        if np.isnan(column).any():
+            column = column[~np.isnan(column)]
+        statistics.append((
+            len(column),
+            np.mean(column, dtype = np.float64) if len(column) > 0 else np.nan,
+            np.std(column, dtype = np.float64, ddof = 1) if len(column) > 1 else np.nan,
+            np.min(column) if len(column) > 0 else np.nan,
+            np.max(column) if len(column) > 0 else np.nan))
+
+    summary = pd.DataFrame(
+        statistics,
+        columns = ["count", "mean", "std", "min", "max"],
+        index = pd.Index(horizons, name = "horizon"))
+    summary["abs_max"] = np.maximum(summary["max"], -summary["min"])
+
+    if __debug__: print("END: summarise_return_matrix()")
+    return(summary)
+
 def analyse_binance_prices(
-    data: pd.DataFrame
-    ) -> None:
+    data: pd.DataFrame,
+    horizons: tuple = HORIZONS
+    ) -> tuple:
     if __debug__: print("START: analyse_binance_prices()")
 
-    # Analyse price difference
-    data["price_close_diff_pct_periods0001"] = data["price_close"].diff(periods = 1)*100/data["price_close"]
-    data["price_close_diff_pct_periods0005"] = data["price_close"].diff(periods = 5)*100/data["price_close"]
-    data["price_close_diff_pct_periods0010"] = data["price_close"].diff(periods = 10)*100/data["price_close"]
+    # Results are new frames, data is only read. Several analyses can run on
+    # the same frame in parallel threads.
 
-    # data["price_close_diff_pct_periods0001"] = data["price_close"].pct_change(periods = 1)*100
+    # Analyse price difference
+    matrix = calc_return_matrix(
+        prices = data["price_close"].to_numpy(),
+        horizons = horizons,
+        dtype = np.float64)
+    returns = pd.DataFrame(
+        matrix,
+        index = data.index,
+        columns = [f"price_close_diff_pct_periods{h:04d}" for h in horizons])
+    summary = summarise_return_matrix(
+        matrix = matrix,
+        horizons = horizons)
 
-    print(f"Price - Diff % - Period  1 - Max: {data['price_close_diff_pct_periods0001'].abs().max()}")
-    print(f"Price - Diff % - Period  5 - Max: {data['price_close_diff_pct_periods0005'].abs().max()}")
-    print(f"Price - Diff % - Period 10 - Max: {data['price_close_diff_pct_periods0010'].abs().max()}")
+    for h, abs_max in summary["abs_max"].items():
+        print(f"Price - Diff % - Period {h:2d} - Max: {abs_max}")
 
     # Analyse trading zones
-    price_close_max = data[
-        ["time_close_year", "time_close_month", "time_close_day", "time_close_hour", "price_close"]
-        ].groupby(
-            by = ["time_close_year", "time_close_month", "time_close_day", "time_close_hour"]
-            ).max()[["price_close"]]
-    price_close_min = data[
-        ["time_close_year", "time_close_month", "time_close_day", "time_close_hour", "price_close"]
-        ].groupby(
-            by = ["time_close_year", "time_close_month", "time_close_day", "time_close_hour"]
-            ).min()[["price_close"]]
+    keys = [
+        data.calendar[name]
+        for name in ("time_close_year", "time_close_month", "time_close_day", "time_close_hour")
+        ]
+    price_close_max = data[["price_close"]].groupby(by = keys).max()
+    price_close_min = data[["price_close"]].groupby(by = keys).min()
     price_close_max.columns = ["price_close_max"]
     price_close_min.columns = ["price_close_min"]
     # print(price_close_max)
@@ -189,7 +1332,111 @@ def analyse_binance_prices(
     print(trading_zones)
         
     if __debug__: print("END: analyse_binance_prices()")
-    return(None)
+    return((returns, trading_zones))
+
+def build_trading_zones(
+    buckets: np.ndarray,
+    price_close_max: np.ndarray,
+    price_close_min: np.ndarray) -> pd.DataFrame:
+    if __debug__: print("START: build_trading_zones()")
+
+    # Same layout as the trading zones of analyse_binance_prices()
+    fields = decompose_epoch_ms(values = buckets)
+    index = pd.MultiIndex.from_arrays(
+        [fields["year"], fields["month"], fields["day"], fields["hour"]],
+        names = ["time_close_year", "time_close_month", "time_close_day", "time_close_hour"])
+    trading_zones = pd.DataFrame({
+        "price_close_max": price_close_max,
+        "price_close_min": price_close_min
+        }, index = index)
+    trading_zones["daily_high_low_abs"] = trading_zones["price_close_max"] - trading_zones["price_close_min"]
+    trading_zones["daily_high_low_pct"] = trading_zones["daily_high_low_abs"]*100/trading_zones["price_close_min"]
+
+    if __debug__: print("END: build_trading_zones()")
+    return(trading_zones)
+
+def aggregate_ohlcv(
+    data: pd.DataFrame,
+    interval: str = "1h") -> pd.DataFrame:
+    if __debug__: print("START: aggregate_ohlcv()")
+
+    # Bars must be sorted by time. Each run of bars falling into the same
+    # interval, counted from the epoch in UTC as Binance does, becomes one bar.
+    interval_ms = INTERVAL_MS[interval]
+    time_open = data["time_open_unix"].to_numpy()
+    buckets = time_open - time_open % interval_ms
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]]) if len(buckets) > 0 else np.array([], dtype = np.int64)
+    ends = np.r_[starts[1:], len(buckets)] - 1
+
+    columns = {"time_open_unix": buckets[starts]}
+    for name, how in OHLCV_AGGREGATIONS.items():
+        if name not in data.columns:
+            continue
+        values = data[name].to_numpy()
+        if len(starts) == 0:
+            columns[name] = values[:0]
+        elif how == "first":
+            columns[name] = values[starts]
+        elif how == "last":
+            columns[name] = values[ends]
+        elif how == "max":
+            columns[name] = np.maximum.reduceat(values, starts)
+        elif how == "min":
+            columns[name] = np.minimum.reduceat(values, starts)
+        else:
+            columns[name] = np.add.reduceat(values, starts)
+    columns["time_close_unix"] = buckets[starts] + interval_ms - 1
+
+    df = pd.DataFrame({name: columns[name] for name in TABLE_HEADER if name in columns})
+    df.index.name = "serial"
+
+    if __debug__: print("END: aggregate_ohlcv()")
+    return(df)
+
+def merge_ohlcv(
+    first: pd.DataFrame,
+    second: pd.DataFrame) -> pd.DataFrame:
+    if __debug__: print("START: merge_ohlcv()")
+
+    # Two single-row bars of the same interval, second following first
+    df = second.reset_index(drop = True)
+    for name, how in OHLCV_AGGREGATIONS.items():
+        if name not in df.columns:
+            continue
+        if how == "first":
+            df[name] = first[name].to_numpy()
+        elif how == "max":
+            df[name] = np.maximum(first[name].to_numpy(), df[name].to_numpy())
+        elif how == "min":
+            df[name] = np.minimum(first[name].to_numpy(), df[name].to_numpy())
+        elif how == "sum":
+            df[name] = first[name].to_numpy() + df[name].to_numpy()
+
+    if __debug__: print("END: merge_ohlcv()")
+    return(df)
+
+def resample_binance_prices(
+    data: pd.DataFrame,
+    interval: str = "1m",
+    resolutions: tuple = RESOLUTIONS) -> dict:
+    if __debug__: print("START: resample_binance_prices()")
+
+    # Only the finest resolution reads data. Every coarser one is aggregated
+    # from the finest resolution built so far that divides it, e.g. 4h from
+    # 1h and 1d from 4h.
+    bars = {}
+    for resolution in sorted(resolutions, key = INTERVAL_MS.get):
+        if INTERVAL_MS[resolution] % INTERVAL_MS[interval] != 0:
+            raise ValueError(f"Resolution {resolution} is not a multiple of {interval}!")
+        bases = [base for base in bars if INTERVAL_MS[resolution] % INTERVAL_MS[base] == 0]
+        if len(bases) > 0:
+            source = bars[max(bases, key = INTERVAL_MS.get)]
+        else:
+            source = data
+        bars[resolution] = aggregate_ohlcv(data = source, interval = resolution)
+
+    if __debug__: print("END: resample_binance_prices()")
+    return(bars)
 
 def save_binance_price_series_to_csv(
     data: pd.DataFrame,
@@ -235,19 +1482,239 @@ def save_binance_price_series_to_parquet(
     if __debug__: print("END: save_binance_price_series_to_parquet()")
     return(None)
 
+def load_binance_watermarks(
+    store_dir: str = STORE_DIR) -> dict:
+    if __debug__: print("START: load_binance_watermarks()")
+
+    # State per "SYMBOL/INTERVAL": the last ingested time_close_unix, the
+    # last time_open_unix scanned for gaps, the gap days fetched again and
+    # those whose download failed. Files holding only the watermark are
+    # read as well.
+    file = os.path.join(store_dir, "watermarks.json")
+    if os.path.isfile(file):
+        with open(file, "r") as f:
+            watermarks = json.load(f)
+    else:
+        watermarks = {}
+    for key, state in watermarks.items():
+        if not isinstance(state, dict):
+            watermarks[key] = {"time_close_unix": state}
+
+    if __debug__: print("END: load_binance_watermarks()")
+    return(watermarks)
+
+def save_binance_watermarks(
+    watermarks: dict,
+    store_dir: str = STORE_DIR) -> None:
+    if __debug__: print("START: save_binance_watermarks()")
+
+    os.makedirs(store_dir, exist_ok = True)
+    fd, temp_file = tempfile.mkstemp(dir = store_dir)
+    with os.fdopen(fd, "w") as f:
+        json.dump(watermarks, f, indent = 4, sort_keys = True)
+    os.replace(temp_file, os.path.join(store_dir, "watermarks.json"))
+
+    if __debug__: print("END: save_binance_watermarks()")
+    return(None)
+
+def read_binance_store(
+    symbol: str = "BTCBUSD",
+    interval: str = "1m",
+    store_dir: str = STORE_DIR,
+    columns: list = None,
+    since: int = None) -> pd.DataFrame:
+    if __debug__: print("START: read_binance_store()")
+
+    # The store holds one Parquet file per month: SYMBOL/INTERVAL/YYYY-MM.parquet
+    path = os.path.join(store_dir, symbol, interval)
+    files = sorted(
+        entry.path for entry in os.scandir(path)
+        if entry.name.endswith(".parquet")) if os.path.isdir(path) else []
+
+    # Bars opened before since are skipped, whole months without reading them
+    filters = None
+    if since is not None:
+        first_month = pd.Timestamp(since, unit = "ms").strftime("%Y-%m")
+        files = [file for file in files if os.path.basename(file)[:7] >= first_month]
+        filters = [("time_open_unix", ">=", since)]
+
+    if len(files) > 0:
+        df = pd.concat(
+            [pd.read_parquet(file, columns = columns, filters = filters) for file in files],
+            ignore_index = True)
+    else:
+        df = pd.DataFrame(columns = TABLE_HEADER if columns is None else columns)
+    df.index.name = "serial"
+
+    if __debug__: print("END: read_binance_store()")
+    return(df)
+
+def write_binance_store(
+    data: pd.DataFrame,
+    symbol: str = "BTCBUSD",
+    interval: str = "1m",
+    store_dir: str = STORE_DIR) -> None:
+    if __debug__: print("START: write_binance_store()")
+
+    # Only the months touched by data are rewritten. New rows replace stored
+    # rows with the same time_open_unix.
+    path = os.path.join(store_dir, symbol, interval)
+    os.makedirs(path, exist_ok = True)
+    months = pd.to_datetime(data["time_open_unix"], unit = "ms").dt.strftime("%Y-%m")
+
+    for month, new in data.groupby(months.to_numpy()):
+        file = os.path.join(path, month + ".parquet")
+        if os.path.isfile(file):
+            new = pd.concat([pd.read_parquet(file), new], ignore_index = True)
+        new = new.drop_duplicates(subset = "time_open_unix", keep = "last")
+        new = new.sort_values("time_open_unix", ignore_index = True)
+        new.index.name = "serial"
+        fd, temp_file = tempfile.mkstemp(dir = path)
+        os.close(fd)
+        new.to_parquet(temp_file)
+        os.replace(temp_file, file)
+        print(f"Rows in {file}: {len(new):,.0f}")
+
+    if __debug__: print("END: write_binance_store()")
+    return(None)
+
+def find_binance_gaps(
+    time_open_unix: np.ndarray,
+    interval: str = "1m") -> list:
+    if __debug__: print("START: find_binance_gaps()")
+
+    # A gap is a step between consecutive bars larger than the interval. The
+    # days covering the missing bars are returned for re-fetching.
+    interval_ms = INTERVAL_MS[interval]
+    time_open_unix = np.unique(np.asarray(time_open_unix, dtype = np.int64))
+    steps = np.diff(time_open_unix)
+    positions = np.flatnonzero(steps > interval_ms)
+
+    days = set()
+    for position in positions:
+        first_missing = (time_open_unix[position] + interval_ms) // DAY_MS
+        last_missing = (time_open_unix[position + 1] - interval_ms) // DAY_MS
+        days.update(range(first_missing, last_missing + 1))
+    dates = [
+        pd.Timestamp(day * DAY_MS, unit = "ms").strftime("%Y-%m-%d")
+        for day in sorted(days)
+        ]
+    print(f"Gaps found: {len(positions)} in {len(dates)} days")
+
+    if __debug__: print("END: find_binance_gaps()")
+    return(dates)
+
+def ingest_binance_incremental(
+    symbol: str = "BTCBUSD",
+    interval: str = "1m",
+    start_date: str = START_DATE,
+    end_date: str = None,
+    store_dir: str = STORE_DIR,
+    cache_dir: str = CACHE_DIR,
+    max_concurrency: int = MAX_CONCURRENCY,
+    scan_gaps: bool = True,
+    binance_domain: str = BINANCE_DOMAIN) -> pd.DataFrame:
+    if __debug__: print("START: ingest_binance_incremental()")
+
+    # The archive of the running day is published the day after
+    if end_date is None:
+        end_date = (pd.Timestamp.now(tz = "UTC") - pd.Timedelta(days = 1)).strftime("%Y-%m-%d")
+
+    domain = binance_domain + f"{symbol}/{interval}/"
+    base = f"{symbol}-{interval}-"
+    key = f"{symbol}/{interval}"
+    watermarks = load_binance_watermarks(store_dir = store_dir)
+    state = watermarks.setdefault(key, {})
+
+    # Continue with the day after the watermark. A day that was stored only
+    # partially is fetched again as a whole.
+    if "time_close_unix" in state:
+        start_date = pd.Timestamp(state["time_close_unix"] + 1, unit = "ms").strftime("%Y-%m-%d")
+    print(f"Ingesting {key} from {start_date} to {end_date}")
+
+    frames = []
+    new_failures = {}
+    if pd.Timestamp(start_date) <= pd.Timestamp(end_date):
+        series = get_binance_hist_price_series(
+            domain = domain,
+            base = base,
+            start_date = start_date,
+            end_date = end_date,
+            cache_dir = cache_dir,
+            max_concurrency = max_concurrency)
+        frames.append(series)
+        new_failures = series.attrs.get("failed_dates", {})
+
+    # Only the time column of bars not scanned before is read to look for
+    # missing bars, starting with the last scanned bar to see a gap right
+    # after it. Days fetched again keep their gaps if Binance has no bars
+    # for them, e.g. during maintenance, and are not fetched a second time.
+    checked = set(state.get("gap_dates_checked", []))
+    dates = set()
+    if scan_gaps and "time_close_unix" in state:
+        stored = read_binance_store(
+            symbol = symbol,
+            interval = interval,
+            store_dir = store_dir,
+            columns = ["time_open_unix"],
+            since = state.get("scanned_time_open_unix"))
+        dates = set(find_binance_gaps(
+            time_open_unix = stored["time_open_unix"].to_numpy(),
+            interval = interval)) - checked
+        if len(stored) > 0:
+            state["scanned_time_open_unix"] = int(stored["time_open_unix"].max())
+
+    # Days that failed on earlier runs, in the range or as gaps, are tried
+    # again whether gaps are scanned or not. The watermark may have moved
+    # past them, and a failed first day has no bar before it to show a gap.
+    dates = sorted(dates | set(state.get("gap_dates_failed", [])))
+    failures = {}
+    if len(dates) > 0:
+        gap_frames, failures = get_binance_hist_prices_batch(
+            archives = [(domain, date) for date in dates],
+            base = base,
+            cache_dir = cache_dir,
+            max_concurrency = max_concurrency)
+        for date, error in failures.items():
+            print(f"Download failed for {date}: {error}")
+        frames.append(assemble_binance_prices(
+            frames = [gap_frames[date] for date in sorted(gap_frames)]))
+    state["gap_dates_checked"] = sorted(checked | (set(dates) - set(failures)))
+    state["gap_dates_failed"] = sorted(set(failures) | set(new_failures))
+
+    df = assemble_binance_prices(frames = [frame for frame in frames if len(frame) > 0])
+
+    if len(df) > 0:
+        write_binance_store(
+            data = df,
+            symbol = symbol,
+            interval = interval,
+            store_dir = store_dir)
+        state["time_close_unix"] = max(int(df["time_close_unix"].max()), state.get("time_close_unix", 0))
+    if len(state) > 0:
+        save_binance_watermarks(
+            watermarks = watermarks,
+            store_dir = store_dir)
+    print(f"Rows ingested for {key}: {len(df):,.0f}")
+
+    if __debug__: print("END: ingest_binance_incremental()")
+    return(df)
+
 #=== MAIN ===
 
 if  __name__ == "__main__":
 
     # prices = get_binance_hist_prices()
-    prices = get_binance_hist_price_series(start_date = START_DATE, end_date = "2022-05-02")
-    prices = prepare_binance_prices(data = prices)
+    # prices = get_binance_hist_price_series(start_date = START_DATE, end_date = "2022-05-02", max_concurrency = MAX_CONCURRENCY)
+    ingest_binance_incremental(symbol = "BTCBUSD", interval = "1m", start_date = START_DATE, end_date = "2022-05-02")
+    prices = read_binance_store(symbol = "BTCBUSD", interval = "1m")
+    prices = prepare_binance_prices(data = prices, lazy = True)
     print(prices.info())
     print(prices.describe())
     analyse_binance_prices(data = prices)
     # save_binance_price_series_to_csv(data = prices)
     # save_binance_price_series_to_excel(data = prices)
-    save_binance_price_series_to_parquet(data = prices)
+    # save_binance_price_series_to_parquet(data = prices)
 
 #=== REFERENCE ===
 
@@ -263,6 +1730,19 @@ if  __name__ == "__main__":
 # *10 = Convert UNIX datetime = https://stackoverflow.com/questions/34883101/pandas-converting-row-with-unix-timestamp-in-milliseconds-to-datetime (cs95)
 # *11 = Extract Year from a datetime column = https://datascienceparichay.com/article/pandas-extract-year-from-datetime-column (Data Science Parichay)
 # *12 = Compute difference between rows = https://pythontic.com/pandas/dataframe-computations/difference#:~:text=Difference%20between%20rows%20or%20columns,row%20from%20the%20next%20row. (pythonic.com)
+# *13 = Running blocking code in asyncio = https://docs.python.org/3/library/asyncio-eventloop.html#executing-code-in-thread-or-process-pools (Python Software Foundation)
+# *14 = Checksums of archives = https://github.com/binance/binance-public-data/#checksum (Binance)
+# *15 = Peak memory of a process = https://docs.python.org/3/library/resource.html#resource.getrusage (Python Software Foundation)
+# *16 = Monthly archives = https://data.binance.vision/?prefix=data/spot/monthly/klines/BTCBUSD/1m/ (Binance)
+# *17 = Thread and process pools = https://docs.python.org/3/library/concurrent.futures.html (Python Software Foundation)
+# *18 = Reading CSV files in chunks = https://pandas.pydata.org/docs/user_guide/io.html#iterating-through-files-chunk-by-chunk (pydata.org)
+# *19 = CSV parsing with pyarrow = https://pandas.pydata.org/docs/user_guide/io.html#io-pyarrow (pydata.org)
+# *20 = Binance public data layout = https://github.com/binance/binance-public-data/#where-do-i-access-it (Binance)
+# *21 = Extending pandas with accessors = https://pandas.pydata.org/docs/development/extending.html#registering-custom-accessors (pydata.org)
+# *22 = Civil from days = https://howardhinnant.github.io/date_algorithms.html#civil_from_days (Howard Hinnant)
+# *23 = Copy-on-Write = https://pandas.pydata.org/docs/user_guide/copy_on_write.html (pydata.org)
+# *24 = Reduce at indices = https://numpy.org/doc/stable/reference/generated/numpy.ufunc.reduceat.html (NumPy Developers)
+# *25 = Sparse table = https://cp-algorithms.com/data_structures/sparse-table.html (cp-algorithms.com)
 
 #== FURTHER INFO ===
 
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+__program__     = http_client.py
+__author__      = "Georg Maubach"
+__authors__     = "Georg Maubach"
+__copyright__   = "(C)opyright 2022, The Algorithmic Stock Trading Project"
+__credits__     = ["Marc Brooker"]
+__license__     = "GPL"
+__maintainer__  = "Georg Maubach"
+__contact__     = "g.maubach@gmx.de"
+__email__       = "g.maubach@gmx.de"
+__created__     = "2026-10-18"
+__updated__     = "2026-10-18"
+__status__      = "Development"
+__version__     = "0.0.1"
+__interpreter__ = "Python 3.8.10"
+"""
+
+#=== USES ===
+
+#--- Standard ---
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import random
+import statistics
+import threading
+import time
+from typing import Final, Iterator
+
+#--- 3rd Party ---
+import requests
+from requests.adapters import HTTPAdapter
+
+#--- MyOwn ---
+
+#=== CONST ===
+
+TIMEOUT: Final[tuple] = (5.0, 60.0) # seconds to connect, seconds between bytes read
+MAX_RETRIES: Final[int] = 5
+BACKOFF_BASE: Final[float] = 0.5
+BACKOFF_MAX: Final[float] = 30.0
+POOL_SIZE: Final[int] = 16
+
+RETRY_STATUS: Final[tuple] = (408, 429, 500, 502, 503, 504)
+
+#=== VAR ===
+
+#=== CLASS ===
+
+class HttpClient:
+    # One keep-alive connection pool shared by all requests of a process.
+    # Requests failing with a connection error, a timeout or a status in
+    # RETRY_STATUS are retried with exponential backoff and full jitter.
+
+    def __init__(
+        self,
+        max_retries: int = MAX_RETRIES,
+        backoff_base: float = BACKOFF_BASE,
+        backoff_max: float = BACKOFF_MAX,
+        timeout: tuple = TIMEOUT,
+        pool_size: int = POOL_SIZE):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    def backoff(self, attempt: int) -> float:
+        # Full jitter: uniform between 0 and the exponential cap *01
+        return(random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt)))
+
+    def get(self, url: str, stream: bool = False, **kwargs) -> requests.Response:
+        for attempt in range(self.max_retries + 1):
+            start = time.perf_counter()
+            try:
+                response = self.session.get(url, stream = stream, timeout = self.timeout, **kwargs)
+                status = response.status_code
+                error = None
+            except (requests.ConnectionError, requests.Timeout) as e:
+                response = None
+                status = None
+                error = e
+            self.record(url = url, attempt = attempt, status = status, seconds = time.perf_counter() - start)
+
+            # Success or a client error like 404 that no retry can fix
+            if response is not None and status not in RETRY_STATUS:
+                response.raise_for_status()
+                return(response)
+
+            if attempt == self.max_retries:
+                if response is not None:
+                    response.raise_for_status()
+                raise error
+
+            # A server asking to come back later is obeyed if it says when
+            delay = self.backoff(attempt)
+            if response is not None:
+                retry_after = response.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = min(self.backoff_max, float(retry_after))
+                response.close()
+            print(f"Retry {attempt + 1} of {self.max_retries} in {delay:.2f} s: {url} ({status if error is None else repr(error)})")
+            time.sleep(delay)
+
+    def iter_content(self, url: str, chunk_size: int, **kwargs) -> Iterator[bytes]:
+        # Streams the body of url. get() only retries until the headers have
+        # arrived, most of a large transfer happens afterwards. A body broken
+        # off is requested again from the received offset with a Range header
+        # *04. Servers ignoring it answer 200 with the full body, which is
+        # then skipped up to the offset. Retries and backoff follow get().
+        headers = dict(kwargs.pop("headers", None) or {})
+        received = 0
+        for attempt in range(self.max_retries + 1):
+            if received > 0:
+                headers["Range"] = f"bytes={received}-"
+            response = self.get(url, stream = True, headers = headers, **kwargs)
+            start = time.perf_counter()
+            skip = received if response.status_code != 206 else 0
+            try:
+                with response:
+                    for block in response.iter_content(chunk_size = chunk_size):
+                        if skip > 0:
+                            block, skip = block[skip:], max(0, skip - len(block))
+                            if len(block) == 0:
+                                continue
+                        received += len(block)
+                        yield block
+                return
+            except requests.RequestException as e:
+                self.record(url = url, attempt = attempt, status = None, seconds = time.perf_counter() - start)
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff(attempt)
+                print(f"Retry {attempt + 1} of {self.max_retries} in {delay:.2f} s after {received:,} bytes: {url} ({e!r})")
+                time.sleep(delay)
+
+    def record(self, url: str, attempt: int, status: int, seconds: float) -> None:
+        with self._lock:
+            self.latencies.append({
+                "url": url,
+                "attempt": attempt,
+                "status": status,
+                "seconds": seconds
+                })
+        return(None)
+
+    def latency_summary(self) -> dict:
+        with self._lock:
+            seconds = sorted(latency["seconds"] for latency in self.latencies)
+            retries = sum(1 for latency in self.latencies if latency["attempt"] > 0)
+        if len(seconds) == 0:
+            return({"requests": 0, "retries": 0})
+        return({
+            "requests": len(seconds),
+            "retries": retries,
+            "mean": statistics.mean(seconds),
+            "p50": seconds[len(seconds) // 2],
+            "p95": seconds[min(len(seconds) - 1, int(len(seconds) * 0.95))],
+            "max": seconds[-1]
+            })
+
+class FaultInjectingHandler(BaseHTTPRequestHandler):
+    # Stand-in for a web server. The first fails[path] requests of a path are
+    # answered with the status in faults[path], are delayed by delay seconds
+    # if that status is 0, or are cut off after half of the body if it is -1.
+    # Later requests get body. Range requests are answered with 206.
+
+    faults = {}
+    fails = {}
+    delay = 0.0
+    body = b"OK"
+
+    def do_GET(self):
+        with self.server.lock:
+            remaining = self.fails.get(self.path, 0)
+            self.fails[self.path] = remaining - 1
+        status = self.faults.get(self.path, 503) if remaining > 0 else 200
+        if status == 0:
+            time.sleep(self.delay)
+        elif status > 200:
+            self.send_error(status)
+            return
+
+        offset = 0
+        if self.headers.get("Range", "").startswith("bytes="):
+            offset = int(self.headers["Range"][6:].split("-")[0])
+        body = self.body[offset:]
+        self.send_response(206 if offset > 0 else 200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if status == -1:
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+#=== FUNCTION ===
+
+def start_fault_server(
+    faults: dict,
+    fails: dict,
+    delay: float = 0.0,
+    body: bytes = b"OK") -> ThreadingHTTPServer:
+    if __debug__: print("START: start_fault_server()")
+
+    handler = type("Handler", (FaultInjectingHandler,), {
+        "faults": faults,
+        "fails": dict(fails),
+        "delay": delay,
+        "body": body
+        })
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.lock = threading.Lock()
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+
+    if __debug__: print("END: start_fault_server()")
+    return(server)
+
+#=== MAIN ===
+
+if  __name__ == "__main__":
+
+    server = start_fault_server(
+        faults = {"/flaky": 503, "/slow": 0, "/missing": 404, "/broken": -1},
+        fails = {"/flaky": 2, "/slow": 1, "/missing": 1, "/broken": 2},
+        delay = 1.0,
+        body = bytes(range(256)) * 4096)
+    root = f"http://127.0.0.1:{server.server_address[1]}"
+    client = HttpClient(backoff_base = 0.01, timeout = (1.0, 0.2))
+
+    print(len(client.get(root + "/flaky").content))
+    print(len(client.get(root + "/slow").content))
+    print(b"".join(client.iter_content(root + "/broken", chunk_size = 65536)) == server.RequestHandlerClass.body)
+    try:
+        client.get(root + "/missing")
+    except requests.HTTPError as e:
+        print(f"Not retried: {e}")
+    print(client.latency_summary())
+
+    server.shutdown()
+
+#=== REFERENCE ===
+
+# *01 = Exponential Backoff And Jitter = https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/ (Marc Brooker)
+# *02 = Session objects = https://requests.readthedocs.io/en/latest/user/advanced/#session-objects (Python Software Foundation)
+# *03 = Timeouts = https://requests.readthedocs.io/en/latest/user/advanced/#timeouts (Python Software Foundation)
+# *04 = Range requests = https://developer.mozilla.org/en-US/docs/Web/HTTP/Range_requests (MDN)
+
+# EOF .